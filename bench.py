@@ -0,0 +1,407 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Benchmarks of the load, lookup, render and scoring paths
+#
+###############################################################################
+
+from time import perf_counter
+import atexit
+import glob
+import importlib.util
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import numpy as np
+
+from hrtf import HRTF_ROOT, HRTFBank, get_closest_key, load_hrtf
+from render import RenderCache, convolve_stereo, render_batch
+from sinks import NullSink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# stored results to compare a run against, see --save. Times only compare
+# on the machine and versions of python, numpy and scipy stored with them
+BASELINE = os.path.join(HERE, "bench_baseline.json")
+
+# what has to match between a run and the baseline for times to compare
+ENVIRONMENT = ("python", "numpy", "scipy", "machine", "processor")
+
+# a benchmark regresses when its best time grows by more than this fraction
+THRESHOLD = 0.25
+
+# short benchmarks are called in a loop until a timed run lasts this long,
+# a single call of a few ms is within the noise of the machine
+MIN_RUN = 0.2
+
+SIGNALS = ("ping.wav", "dryspeech.wav")
+NOISE_SECONDS = 10
+
+def measure(function, repeat=5, number=1, min_run=MIN_RUN):
+  """
+  @brief      { Times a function, keeping the best and median of repeat runs }
+
+  @param      function  called without arguments
+  @param      repeat    Number of timed runs
+  @param      number    least calls per run
+  @param      min_run   more calls are made per run until it lasts this long
+
+  @return     { dict of min and median seconds per call }
+  """
+  start = perf_counter()
+  function()
+  once = max(perf_counter() - start, 1e-9)
+  number = max(number, int(math.ceil(min_run / once)))
+
+  times = list()
+  for _ in range(repeat):
+    start = perf_counter()
+    for _ in range(number):
+      function()
+    times.append((perf_counter() - start) / number)
+  return {
+    "min": min(times),
+    "median": float(np.median(times)),
+    "repeat": repeat,
+    "number": number
+  }
+
+def load_process():
+  # results/ is a folder of scripts rather than a package
+  spec = importlib.util.spec_from_file_location(
+    "process",
+    os.path.join(HERE, "results", "process.py")
+  )
+  process = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(process)
+  return process
+
+def signal_names():
+  return [os.path.splitext(name)[0] for name in SIGNALS] + [
+    "noise{}s".format(NOISE_SECONDS)
+  ]
+
+def read_signals():
+  import soundfile as sf
+
+  signals = list()
+  for name in SIGNALS:
+    data, fs = sf.read(os.path.join(HERE, name))
+    if data.ndim > 1:
+      data = data[:, 0]
+    signals.append((data, fs))
+  noise = np.random.RandomState(0).randn(NOISE_SECONDS * 44100) * 0.1
+  signals.append((noise, 44100))
+  return signals
+
+def cases(open_bank=None, root=HRTF_ROOT):
+  """
+  @brief      { Lists the benchmarks, each with its setup still to run }
+
+  @param      open_bank  returns the bank renders are timed with
+  @param      root       The dataset directory
+
+  @return     { list of (name, setup) where setup() returns (function,
+                number, items), items being what one call processes }
+  """
+  if open_bank is None:
+    open_bank = lambda: HRTFBank.open(root)
+  state = dict()
+
+  def bank():
+    if "bank" not in state:
+      state["bank"] = open_bank()
+    return state["bank"]
+
+  def signals():
+    if "signals" not in state:
+      state["signals"] = read_signals()
+    return state["signals"]
+
+  found = [
+    ("load.cold", lambda: cold_load(root)),
+    ("load.warm", lambda: (lambda: HRTFBank.open(root), 1, 1)),
+    ("load.load_hrtf", lambda: (lambda: load_hrtf(root), 1, 1)),
+    ("lookup.bank", lambda: lookup_bank(bank())),
+    ("lookup.get_closest_key", lambda: lookup_closest_key(root)),
+  ]
+
+  # the long noise is left out of the batch, 72 renders of it take 250 MB
+  for index, name in enumerate(signal_names()):
+    found.append(("render.{}".format(name), (
+      lambda index=index: render_single(bank(), signals()[index])
+    )))
+    found.append(("render.{}.interpolate".format(name), (
+      lambda index=index: render_single(bank(), signals()[index], True)
+    )))
+    if index < len(SIGNALS):
+      found.append(("render.{}.batch72".format(name), (
+        lambda index=index: render_directions(bank(), signals()[index])
+      )))
+  found.append(("render.cache_hit", lambda: render_hit(bank(), signals()[0])))
+  found.append(("trial.null_sink", lambda: trial(bank(), signals()[0])))
+  found.append(("score.files", scoring))
+  return found
+
+def cold_load(root):
+  # compiled into a copy of the dataset, the cache in root may be mapped
+  # by sessions running meanwhile
+  directory = tempfile.mkdtemp()
+  atexit.register(shutil.rmtree, directory, True)
+  for name in os.listdir(root):
+    if name.startswith("elev"):
+      shutil.copytree(os.path.join(root, name), os.path.join(directory, name))
+  return (lambda: HRTFBank.open(directory, rebuild=True), 1, 1)
+
+def lookup_bank(bank):
+  state = np.random.RandomState(1)
+  elevations = state.uniform(-40, 90, 100000)
+  azimuths = state.uniform(0, 360, 100000)
+  return (lambda: bank.lookup(elevations, azimuths), 1, len(elevations))
+
+def lookup_closest_key(root):
+  hrtf = load_hrtf(root)
+  state = np.random.RandomState(1)
+  directions = list(zip(
+    state.randint(-40, 91, 1000).tolist(),
+    state.randint(0, 360, 1000).tolist()
+  ))
+
+  def closest():
+    for elevation, azimuth in directions:
+      key = get_closest_key(hrtf['L'].keys(), elevation)
+      get_closest_key(hrtf['L'][key].keys(), azimuth)
+  return (closest, 1, len(directions))
+
+def render_single(bank, signal, interpolate=False):
+  data, fs = signal
+  return (
+    lambda: convolve_stereo(data, bank, 10, 30, interpolate=interpolate,
+                            fs=fs),
+    1,
+    1
+  )
+
+def render_directions(bank, signal):
+  data, fs = signal
+  directions = [(0, azimuth) for azimuth in range(0, 360, 5)]
+  return (lambda: render_batch(data, bank, directions, fs=fs), 1, 72)
+
+def render_hit(bank, signal):
+  data, fs = signal
+  renders = RenderCache(bank)
+  renders.render(data, 0, 30, fs)
+  return (lambda: renders.render(data, 0, 30, fs), 1, 1)
+
+def trial(bank, signal):
+  data, fs = signal
+  sink = NullSink(realtime=False)
+
+  def play():
+    sink.play(convolve_stereo(data, bank, 0, 30, fs=fs), fs)
+    sink.wait()
+  return (play, 1, 1)
+
+def scoring(copies=50):
+  process = load_process()
+  directory = tempfile.mkdtemp()
+  atexit.register(shutil.rmtree, directory, True)
+  paths = list()
+  for copy in range(copies):
+    for path in sorted(glob.glob(os.path.join(HERE, "results", "*.csv"))):
+      paths.append(os.path.join(directory, "{}-{}".format(
+        copy,
+        os.path.basename(path)
+      )))
+      shutil.copy(path, paths[-1])
+
+  def score():
+    for path in paths:
+      process.score(process.read_results(path))
+  return (score, 1, len(paths))
+
+def run(open_bank=None, root=HRTF_ROOT, only=None, repeat=5, log=None):
+  """
+  @brief      { Runs the benchmarks }
+
+  @param      open_bank  returns the bank renders are timed with
+  @param      root       The dataset directory
+  @param      only       name prefixes to run, None for all
+  @param      repeat     timed runs of each benchmark
+  @param      log        file progress is written to, None for quiet
+
+  @return     { dict ready to be dumped as json }
+  """
+  import scipy
+
+  results = dict()
+  for name, setup in cases(open_bank, root):
+    if only and not any(name.startswith(prefix) for prefix in only):
+      continue
+    function, number, items = setup()
+    # the first call pays for caches that later calls share
+    function()
+    results[name] = measure(function, repeat, number)
+    results[name]["items"] = items
+    if log is not None:
+      log.write("{:36s} {:10.3f} ms\n".format(
+        name,
+        results[name]["min"] * 1000
+      ))
+      log.flush()
+
+  return {
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "scipy": scipy.__version__,
+    "machine": platform.machine(),
+    "processor": platform.processor(),
+    "results": results
+  }
+
+def combine(reports):
+  """
+  @brief      { Merges several runs into a baseline }
+
+  The best times of one case move from run to run by more than within a
+  run, so each case keeps the median of its best times and how far they
+  spread, its noise.
+
+  @param      reports  dicts returned by run()
+
+  @return     { dict like run() returns, with noise in every result }
+  """
+  combined = dict(reports[0])
+  combined["rounds"] = len(reports)
+  combined["results"] = dict()
+  for name, result in reports[0]["results"].items():
+    best = [report["results"][name]["min"] for report in reports]
+    result = dict(result)
+    result["min"] = float(np.median(best))
+    result["noise"] = (max(best) - min(best)) / result["min"]
+    combined["results"][name] = result
+  return combined
+
+def compare(report, baseline, threshold=THRESHOLD):
+  """
+  @brief      { Compares the best times of a run with the baseline }
+
+  @param      report     dict returned by run()
+  @param      baseline   dict returned by combine()
+  @param      threshold  allowed growth of the best time on top of the
+                         noise of each case, 0.25 = 25%
+
+  @return     { list of (name, baseline s, now s, ratio, regressed) }
+  """
+  rows = list()
+  for name, result in sorted(report["results"].items()):
+    before = baseline["results"].get(name)
+    if before is None:
+      continue
+    ratio = result["min"] / before["min"]
+    rows.append((name, before["min"], result["min"], ratio,
+                 ratio > 1 + threshold + before.get("noise", 0.0)))
+  return rows
+
+def read_baseline(path):
+  try:
+    with open(path, "r") as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+def add_arguments(parser):
+  parser.add_argument("--only", nargs="*", default=None,
+                      help="run the benchmarks starting with these names")
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="timed runs of each benchmark")
+  parser.add_argument("--json", default=None,
+                      help="write the results to this file, - for stdout")
+  parser.add_argument("--baseline", default=BASELINE,
+                      help="results to compare against")
+  parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                      help="allowed slow down, 0.25 = 25%%")
+  parser.add_argument("--save", action="store_true",
+                      help="store the results as the new baseline")
+  parser.add_argument("--rounds", type=int, default=3,
+                      help="runs merged into a saved baseline")
+
+def main(args, open_bank=None):
+  """
+  @brief      { Runs the benchmarks from parsed command line arguments }
+
+  @param      args       namespace with the options of add_arguments()
+  @param      open_bank  returns the bank renders are timed with
+
+  @return     { exit status, 1 if anything regressed }
+  """
+  report = run(open_bank, args.root, args.only, args.repeat, sys.stderr)
+
+  if args.json == "-":
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+  elif args.json is not None:
+    with open(args.json, "w") as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+
+  if args.save:
+    reports = [report] + [
+      run(open_bank, args.root, args.only, args.repeat, sys.stderr)
+      for _ in range(args.rounds - 1)
+    ]
+    baseline = combine(reports)
+    if args.only:
+      # the cases left out keep their stored times
+      kept = read_baseline(args.baseline)
+      if kept is not None:
+        kept["results"].update(baseline["results"])
+        baseline["results"] = kept["results"]
+    with open(args.baseline, "w") as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+    return 0
+
+  baseline = read_baseline(args.baseline)
+  if baseline is None:
+    sys.stderr.write("no baseline at {}\n".format(args.baseline))
+    return 0
+
+  for key in ENVIRONMENT:
+    if baseline.get(key) != report[key]:
+      sys.stderr.write("baseline {} is {}, this run's is {}\n".format(
+        key,
+        baseline.get(key),
+        report[key]
+      ))
+
+  regressed = 0
+  sys.stderr.write("\n{:36s} {:>10s} {:>10s} {:>7s}\n".format(
+    "benchmark", "baseline", "now", "ratio"
+  ))
+  for name, before, now, ratio, slower in compare(
+    report,
+    baseline,
+    args.threshold
+  ):
+    regressed += slower
+    sys.stderr.write("{:36s} {:8.3f}ms {:8.3f}ms {:6.2f}x{}\n".format(
+      name,
+      before * 1000,
+      now * 1000,
+      ratio,
+      "  REGRESSION" if slower else ""
+    ))
+  return 1 if regressed else 0
+
+if __name__ == '__main__':
+  # python bench.py [--only render] [--json -] [--save]
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Time the hot paths")
+  parser.add_argument("--root", default=HRTF_ROOT, help="dataset directory")
+  add_arguments(parser)
+  sys.exit(main(parser.parse_args()))
@@ -0,0 +1,183 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  The circle of directions the listener answers on
+#
+###############################################################################
+
+import curses
+import math
+
+# degrees between the labels around the circle
+LABEL_STEP = 10
+
+def check_step(step, label_step=LABEL_STEP):
+  """
+  @brief      { Raises ValueError unless the cursor can reach every label }
+
+  @param      step        degrees the cursor moves by
+  @param      label_step  degrees between the labels
+  """
+  if step <= 0 or 90 % step or label_step % step:
+    raise ValueError("step must divide 90 and label_step, got {} and {}"
+                     .format(step, label_step))
+
+def move_selection(selected, key, step=10):
+  """
+  @brief      { Moves the cursor around the circle for an arrow key }
+
+  Right and left move towards 90 and 270 degrees, up and down towards 0
+  and 180, stopping there.
+
+  @param      selected  The selected direction in degrees
+  @param      key       The key pressed
+  @param      step      degrees between the directions on the circle
+
+  @return     { the new selection }
+  """
+  if key == curses.KEY_RIGHT and selected != 90:
+    selected += step if selected > 270 or selected < 90 else -step
+  elif key == curses.KEY_LEFT and selected != 270:
+    selected += -step if selected > 270 or selected < 90 else step
+  elif key == curses.KEY_UP and selected != 0:
+    selected += -step if selected < 180 else step
+  elif key == curses.KEY_DOWN and selected != 180:
+    selected += step if selected < 180 else -step
+  return selected % 360
+
+class CircleSelector(object):
+  """
+  @brief      { Degree labels around the screen with a movable selection }
+
+  Label coordinates are worked out once per terminal size, and a move only
+  repaints the cells of the old and the new selection, so a keypress costs
+  the same whatever the resolution.
+
+  Every label_step degrees gets a label. A selection between labels, at
+  the finer resolutions, is shown by a marker just inside the ring.
+  """
+
+  MARKER = "o"
+
+  def __init__(self, window, step=10, label_step=LABEL_STEP, selected=0):
+    check_step(step, label_step)
+    self.window = window
+    self.step = step
+    self.label_step = label_step
+    self.selected = selected
+    self.size = None
+    self.labels = dict()
+    self.markers = dict()
+    self.layout()
+
+  def layout(self):
+    """
+    @brief      { Works out where everything goes for the current size }
+    """
+    self.size = self.window.getmaxyx()
+    self.radius = min(self.size)//2
+    self.labels = dict(
+      (degrees, self.position(degrees, str(degrees)))
+      for degrees in range(0, 360, self.label_step)
+    )
+    self.markers = dict(
+      (degrees, self.position(degrees, self.MARKER, 1))
+      for degrees in range(0, 360, self.step)
+      if degrees % self.label_step
+    )
+
+  def position(self, degrees, text, inset=0):
+    """
+    @brief      { Screen cell text is centered on at a direction }
+
+    @param      degrees  The direction
+    @param      text     The text to be drawn there
+    @param      inset    rows inside the ring of labels
+
+    @return     { (row, column) }
+    """
+    radius = self.radius - inset
+    return (
+      self.size[0]//2 - int(radius * math.cos(math.pi/180 * degrees)),
+      self.size[1]//2 - len(text)//2
+        + int(2 * radius * math.sin(math.pi/180 * degrees))
+    )
+
+  def add(self, row, column, text, attribute):
+    try:
+      self.window.addstr(row, column, text, attribute)
+    except curses.error:
+      # off a terminal too small for the circle
+      pass
+
+  def paint(self, degrees, attribute):
+    if degrees in self.labels:
+      self.add(*(self.labels[degrees] + (str(degrees), attribute)))
+    else:
+      self.add(*(self.markers[degrees] + (
+        self.MARKER if attribute != curses.A_NORMAL else " ",
+        attribute
+      )))
+
+  def draw(self):
+    """
+    @brief      { Paints every label, after a clear or a resize }
+    """
+    if self.window.getmaxyx() != self.size:
+      self.layout()
+    for degrees in self.labels:
+      self.paint(degrees, curses.A_NORMAL)
+    self.paint(self.selected, curses.A_REVERSE)
+
+  def point(self, degrees, text, attribute, inset=2):
+    """
+    @brief      { Draws text inside the ring, e.g. a hint of the answer }
+    """
+    self.add(*(self.position(degrees, text, inset) + (text, attribute)))
+
+  def handle(self, key):
+    """
+    @brief      { Moves the selection for an arrow key }
+
+    Only the cells of the old and the new selection are repainted. A resize
+    only lays the circle out again, the caller redraws the screen.
+
+    @param      key   The key pressed
+
+    @return     { True when the screen needs a full redraw }
+    """
+    if key == curses.KEY_RESIZE:
+      self.layout()
+      return True
+    selected = move_selection(self.selected, key, self.step)
+    if selected != self.selected:
+      self.paint(self.selected, curses.A_NORMAL)
+      self.selected = selected
+      self.paint(self.selected, curses.A_REVERSE)
+    return False
+
+if __name__ == '__main__':
+  # python circle.py [--step 5] [--labels 30], pick a direction
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Try the circle selector")
+  parser.add_argument("--step", type=int, default=10,
+                      help="degrees the cursor moves by")
+  parser.add_argument("--labels", type=int, default=LABEL_STEP,
+                      help="degrees between labels")
+  args = parser.parse_args()
+
+  def pick(stdscr):
+    curses.curs_set(0)
+    circle = CircleSelector(stdscr, args.step, args.labels)
+    circle.draw()
+    while True:
+      key = stdscr.getch()
+      if key in (curses.KEY_ENTER, ord('\r'), ord('\n')):
+        return circle.selected
+      if circle.handle(key):
+        stdscr.clear()
+        circle.draw()
+
+  print(curses.wrapper(pick))
@@ -0,0 +1,119 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Per trial event log, one json object per line
+#
+###############################################################################
+
+from time import perf_counter, time
+import json
+import queue
+import threading
+
+class EventLog(object):
+  """
+  @brief      { Appends timestamped events to a json lines file }
+
+  log() only stamps the event and queues it, a writer thread turns events
+  into lines and flushes whenever it runs out of them, so the audio and
+  input paths never wait on the disk.
+
+  Times are perf_counter() seconds since the log was opened, the clock the
+  sinks time their buffers with. The first event of a session maps them to
+  the wall clock.
+  """
+
+  def __init__(self, path, **session):
+    self.path = path
+    self.started = perf_counter()
+    self.pending = queue.Queue()
+    self.f = open(path, "a")
+
+    self.writer = threading.Thread(target=self._run)
+    self.writer.daemon = True
+    self.writer.start()
+
+    session["wall"] = time()
+    self.log("session", **session)
+
+  def since(self, t):
+    """
+    @brief      { Converts a perf_counter() time to the clock of the log }
+    """
+    return None if t is None else t - self.started
+
+  def log(self, event, t=None, **fields):
+    """
+    @brief      { Queues an event }
+
+    @param      event   The name of the event
+    @param      t       perf_counter() time it happened, None for now
+    @param      fields  anything json can hold
+    """
+    fields["event"] = event
+    fields["t"] = self.since(perf_counter() if t is None else t)
+    self.pending.put(fields)
+
+  def _run(self):
+    while True:
+      fields = self.pending.get()
+      while fields is not None:
+        self.f.write(json.dumps(fields, sort_keys=True) + "\n")
+        try:
+          fields = self.pending.get_nowait()
+        except queue.Empty:
+          break
+      self.f.flush()
+      if fields is None:
+        return
+
+  def close(self):
+    self.pending.put(None)
+    self.writer.join()
+    self.f.close()
+
+def read_events(path):
+  """
+  @brief      { Reads an event log back }
+
+  @param      path  The path to the log
+
+  @return     { list of event dicts, in the order they were written }
+  """
+  with open(path, "r") as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+if __name__ == '__main__':
+  # python events.py events.jsonl, reaction times of the last session
+  import argparse
+  import numpy as np
+
+  parser = argparse.ArgumentParser(description="Summarize an event log")
+  parser.add_argument("path", help="event log")
+  args = parser.parse_args()
+
+  events = read_events(args.path)
+  starts = [index for index, event in enumerate(events)
+            if event["event"] == "session"]
+  events = events[starts[-1]:] if starts else events
+
+  def column(name, field):
+    return np.array([
+      event[field] for event in events
+      if event["event"] == name and event.get(field) is not None
+    ], dtype=float)
+
+  for name, values in (
+    ("reaction time", column("selection", "reaction")),
+    ("render time", column("render_end", "duration")),
+    ("submit to first frame", column("played", "latency")),
+    ("first frame after due", column("played", "lateness"))
+  ):
+    if len(values):
+      print("{:24s} median {:8.3f} s  max {:8.3f} s  ({} trials)".format(
+        name,
+        np.median(values),
+        values.max(),
+        len(values)
+      ))
@@ -0,0 +1,1334 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  HRTF dataset loading (MIT KEMAR, full set)
+#
+###############################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+import json
+import os
+import re
+import numpy as np
+from scipy.signal import resample_poly
+from scipy.spatial import ConvexHull, cKDTree
+import instrument
+
+HRTF_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "full")
+
+# the KEMAR measurements were taken at 44.1 kHz
+NATIVE_RATE = 44100
+
+CACHE_NAME = "bank"
+CACHE_VERSION = 5
+
+HEADPHONES_DIR = "headphones+spkr"
+# headphone inverses stop boosting this far below the peak response (dB)
+INVERSE_RANGE = 30.0
+
+# resampled filters stay within this error, relative to the peak of each
+# spectrum, below RESAMPLE_BAND of the lower Nyquist frequency (-40 dB)
+RESAMPLE_TOLERANCE = 0.01
+RESAMPLE_BAND = 0.8
+
+# an onset is the first sample reaching this fraction of the peak
+ONSET_THRESHOLD = 0.2
+
+# fractional delays are Kaiser windowed sincs, flat to about 1% below
+# RESAMPLE_BAND of the Nyquist frequency
+DELAY_TAPS = 24
+DELAY_BETA = 3.4
+
+# MIT KEMAR file names look like L-10e005a.dat: side, elevation, azimuth
+DAT_PATTERN = re.compile(r"^([LR])(-?\d+)e(\d{3})a\.dat$")
+
+def read_raw(path):
+  """
+  @brief      { Reads an hrtf file as raw samples in a single buffer read }
+
+  @param      path  The path to the .dat file
+
+  @return     { int16 array of the samples }
+  """
+  # byte ordering must be in reverse: '>' (big endian)
+  return np.fromfile(path, dtype=">i2")
+
+def scan_dat(root=HRTF_ROOT):
+  """
+  @brief      { Lists every hrtf file in the dataset }
+
+  @param      root  The dataset directory
+
+  @return     { sorted list of (side, elevation, azimuth, path) tuples }
+  """
+  entries = list()
+  for directory in os.listdir(root):
+    if not directory.startswith("elev"):
+      continue
+    for name in os.listdir(os.path.join(root, directory)):
+      match = DAT_PATTERN.match(name)
+      if match is None:
+        continue
+      entries.append((
+        match.group(1),
+        int(match.group(2)),
+        int(match.group(3)),
+        os.path.join(root, directory, name)
+      ))
+  entries.sort()
+  return entries
+
+@instrument.timed("hrtf.read_all")
+def read_all(root=HRTF_ROOT, workers=8, dtype=np.float64):
+  """
+  @brief      { Reads and normalizes every hrtf file in the dataset }
+
+  @param      root     The dataset directory
+  @param      workers  Number of threads reading files in parallel
+  @param      dtype    The dtype of the normalized responses
+
+  @return     { (entries, responses) where responses[i] belongs to entries[i] }
+  """
+  entries = scan_dat(root)
+
+  # file reads release the GIL, so the threads overlap the disk access
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    raw = list(pool.map(read_raw, [entry[3] for entry in entries]))
+
+  # normalize every direction in one vectorized step
+  responses = np.stack(raw).astype(dtype) / dtype(32768)
+  return entries, responses
+
+@instrument.timed("hrtf.load_hrtf")
+def load_hrtf(root=HRTF_ROOT, workers=8, cache=True):
+  """
+  @brief      { Loads all the hrtfs available }
+
+  @param      root     The dataset directory
+  @param      workers  Number of threads reading files in parallel
+  @param      cache    Map the compiled bank instead of parsing the tree,
+                       the filters are then float32 views into it
+
+  @return     { 
+    data structure for HRTF data:
+      elevation ranges from -40 to +90 in increments of 10
+      azimuth ranges from 0 to 355, spacing depends on the elevation
+      left and right
+    3D array of key value pairs:
+ 
+    HRTF = {
+      L: {
+        -40 : {
+          0 : list(data),
+          .
+          .
+          .
+        },
+      .
+      .
+      .
+      },
+      R: {
+        .
+        .
+        .
+      }
+    }
+ 
+  }
+  """
+  if cache:
+    return HRTFBank.open(root, workers).to_dict()
+
+  entries, responses = read_all(root, workers)
+
+  hrtf = dict()
+  hrtf['L'] = dict()
+  hrtf['R'] = dict()
+  for (side, elevation, azimuth, _), response in zip(entries, responses):
+    hrtf[side].setdefault(elevation, dict())[azimuth] = response
+
+  return hrtf
+
+def get_closest_key(keys, target):
+  """
+  @brief      { Gets the closest key }
+  
+  @param      keys    The keys
+  @param      target  The target
+  
+  @return     { The closest key }
+  """
+  return target if target in keys else min(
+  	keys, 
+  	key=lambda k: abs(k - target)
+  )
+
+def source_manifest(paths, root=HRTF_ROOT):
+  """
+  @brief      { Describes the source files a compiled bank was built from }
+
+  @param      paths  The source files
+  @param      root   The dataset directory
+
+  @return     { dict of relative path -> [size, mtime in ns] }
+  """
+  files = dict()
+  for path in paths:
+    stat = os.stat(path)
+    files[os.path.relpath(path, root)] = [
+      stat.st_size,
+      int(stat.st_mtime * 1e9)
+    ]
+  return files
+
+def cache_paths(root=HRTF_ROOT, name=CACHE_NAME):
+  """
+  @brief      { Files a compiled bank is stored in }
+
+  @param      root  The dataset directory
+  @param      name  The name of the bank, one per derived variant
+
+  @return     { (filters, index, manifest) paths }
+  """
+  return (
+    os.path.join(root, name + ".npy"),
+    os.path.join(root, name + "_index.npy"),
+    os.path.join(root, name + ".json")
+  )
+
+def compile_bank(bank, root=HRTF_ROOT, entries=None, name=CACHE_NAME,
+                 sources=()):
+  """
+  @brief      { Writes a bank next to the dataset so it can be mapped later }
+
+  @param      bank     The HRTFBank to store
+  @param      root     The dataset directory
+  @param      entries  The scan_dat() entries the bank was built from
+  @param      name     The name of the bank, one per derived variant
+  @param      sources  Other files the bank was derived from
+
+  @return     { path of the compiled bank }
+  """
+  if entries is None:
+    entries = scan_dat(root)
+
+  manifest = {
+    "version": CACHE_VERSION,
+    "shape": list(bank.filters.shape),
+    "elevations": bank.elevations.tolist(),
+    "azimuths": bank.azimuths.tolist(),
+    "right_side": bank.right_side,
+    "fs": bank.fs,
+    "delays": None if bank.delays is None else bank.delays.tolist(),
+    "files": source_manifest(
+      [entry[3] for entry in entries] + list(sources),
+      root
+    )
+  }
+
+  # write under a temporary name and rename, so a concurrent reader never
+  # maps a half written file
+  cache_path, index_path, manifest_path = cache_paths(root, name)
+  suffix = ".{}.tmp".format(os.getpid())
+
+  with open(cache_path + suffix, "wb") as f:
+    np.save(f, bank.filters)
+  os.replace(cache_path + suffix, cache_path)
+
+  with open(index_path + suffix, "wb") as f:
+    np.save(f, bank.nearest)
+  os.replace(index_path + suffix, index_path)
+
+  with open(manifest_path + suffix, "w") as f:
+    json.dump(manifest, f)
+  os.replace(manifest_path + suffix, manifest_path)
+
+  return cache_path
+
+def open_compiled(root=HRTF_ROOT, name=CACHE_NAME, sources=()):
+  """
+  @brief      { Maps the compiled bank if it is still up to date }
+
+  @param      root     The dataset directory
+  @param      name     The name of the bank, one per derived variant
+  @param      sources  Other files the bank was derived from
+
+  @return     { HRTFBank arguments as a dict, or None if stale or missing }
+  """
+  cache_path, index_path, manifest_path = cache_paths(root, name)
+  try:
+    with open(manifest_path, "r") as f:
+      manifest = json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+  if manifest.get("version") != CACHE_VERSION:
+    return None
+  paths = [entry[3] for entry in scan_dat(root)] + list(sources)
+  if manifest.get("files") != source_manifest(paths, root):
+    return None
+
+  try:
+    filters = np.load(cache_path, mmap_mode="r")
+    nearest = np.load(index_path, mmap_mode="r")
+  except (IOError, OSError, ValueError):
+    return None
+
+  if list(filters.shape) != manifest["shape"]:
+    return None
+  return {
+    "filters": filters,
+    "elevations": manifest["elevations"],
+    "azimuths": manifest["azimuths"],
+    "nearest": nearest,
+    "right_side": manifest["right_side"],
+    "fs": manifest["fs"],
+    "delays": manifest["delays"]
+  }
+
+def headphone_models(root=HRTF_ROOT):
+  """
+  @brief      { Lists the compensation filters shipped with the dataset }
+
+  @param      root  The dataset directory
+
+  @return     { sorted model names, e.g. AKG-K240 or Opti }
+  """
+  models = set()
+  for name in os.listdir(os.path.join(root, HEADPHONES_DIR)):
+    name = os.path.splitext(name)[0]
+    if name.endswith("-L") or name.endswith("-R"):
+      models.add(name[:-2])
+    elif name == "Opti-inverse":
+      models.add("Opti")
+  return sorted(models)
+
+def minimum_phase(magnitude, fft_size):
+  """
+  @brief      { Minimum phase impulse response with the given magnitude }
+
+  Folds the real cepstrum of the log magnitude onto positive quefrencies.
+
+  @param      magnitude  magnitude response, fft_size // 2 + 1 bins
+  @param      fft_size   The transform length
+
+  @return     { impulse response of fft_size samples }
+  """
+  cepstrum = np.fft.irfft(np.log(np.maximum(magnitude, 1e-12)), n=fft_size)
+  fold = np.zeros(fft_size)
+  fold[0] = 1
+  fold[1:(fft_size + 1) // 2] = 2
+  if fft_size % 2 == 0:
+    fold[fft_size // 2] = 1
+  return np.fft.irfft(np.exp(np.fft.rfft(cepstrum * fold)), n=fft_size)
+
+def fade_out(filters, length):
+  """
+  @brief      { Truncates filters with a half Hann window over the end }
+
+  @param      filters  array shaped (..., taps)
+  @param      length   The length to keep
+
+  @return     { array shaped (..., length) }
+  """
+  filters = np.array(filters[..., :length])
+  fade = max(1, length // 8)
+  filters[..., length - fade:] *= 0.5 + 0.5 * np.cos(
+    np.pi * (np.arange(fade) + 1) / fade
+  )
+  return filters
+
+def sinc_weights(delays, taps=DELAY_TAPS):
+  """
+  @brief      { Splits delays into a shift and a windowed sinc interpolator }
+
+  The interpolator is centred on the fraction, which is accurate for delays
+  of at least taps // 2 samples.
+
+  @param      delays  array of delays in samples
+  @param      taps    The length of the interpolator
+
+  @return     { (int shifts, weights shaped (..., taps)) }
+  """
+  delays = np.asarray(delays, dtype=np.float64)
+  shifts = np.maximum(np.floor(delays).astype(np.int64) - taps // 2 + 1, 0)
+  offsets = (shifts - delays)[..., np.newaxis] + np.arange(taps)
+  window = np.i0(
+    DELAY_BETA * np.sqrt(np.clip(1 - (offsets / (taps / 2.0)) ** 2, 0, 1))
+  ) / np.i0(DELAY_BETA)
+  return shifts, np.sinc(offsets) * window
+
+def delay_room(delays, taps=DELAY_TAPS):
+  """
+  @brief      { Samples fractional_delay() adds after the signals }
+
+  @param      delays  array of delays in samples
+  @param      taps    The length of the interpolator
+
+  @return     { number of samples }
+  """
+  return int(max(np.floor(np.max(delays)) - taps // 2 + 1, 0)) + taps - 1
+
+def fractional_delay(signals, delays, room, taps=DELAY_TAPS):
+  """
+  @brief      { Delays every signal by a fractional number of samples }
+
+  The integer part is an offset into the output and the fraction a short
+  interpolator, so a sample costs taps multiplies whatever the delay.
+
+  @param      signals  array shaped (..., samples)
+  @param      delays   delay of each signal in samples, shaped (...)
+  @param      room     samples added at the end, at least delay_room()
+  @param      taps     The length of the interpolator
+
+  @return     { array shaped (..., samples + room) }
+  """
+  signals = np.asarray(signals)
+  samples = signals.shape[-1]
+  out = np.zeros(signals.shape[:-1] + (samples + room,), dtype=signals.dtype)
+
+  shifts, weights = sinc_weights(
+    np.broadcast_to(delays, signals.shape[:-1]),
+    taps
+  )
+  for signal, delayed, shift, interpolator in zip(
+    signals.reshape(-1, samples),
+    out.reshape(-1, samples + room),
+    shifts.ravel(),
+    weights.reshape(-1, taps)
+  ):
+    for tap, weight in enumerate(interpolator):
+      delayed[shift + tap:shift + tap + samples] += weight * signal
+  return out
+
+def split_delays(filters, delays):
+  """
+  @brief      { Folds the fraction of each delay into its filter }
+
+  What is left is a whole number of samples, which costs nothing to apply
+  to the output.
+
+  @param      filters  minimum phase filters shaped (..., taps)
+  @param      delays   delays in samples shaped (...)
+
+  @return     { (filters shaped (..., taps + DELAY_TAPS), int shifts) }
+  """
+  shifts = np.maximum(np.floor(delays).astype(np.int64) - DELAY_TAPS // 2, 0)
+  return fractional_delay(filters, delays - shifts, DELAY_TAPS), shifts
+
+def compensation_sources(model, minimum=True, root=HRTF_ROOT):
+  """
+  @brief      { The files the compensation filter of a model is made from }
+
+  @param      model    a name from headphone_models()
+  @param      minimum  Minimum phase, otherwise linear phase
+  @param      root     The dataset directory
+
+  @return     { list of paths, raises ValueError for an unknown model }
+  """
+  directory = os.path.join(root, HEADPHONES_DIR)
+  if model == "Opti":
+    return [os.path.join(
+      directory,
+      "Opti-minphase.dat" if minimum else "Opti-inverse.dat"
+    )]
+
+  paths = [os.path.join(directory, "{}-{}.dat".format(model, side))
+           for side in HRTFBank.SIDES]
+  for path in paths:
+    if not os.path.exists(path):
+      raise ValueError("unknown headphone model {}, pick one of {}".format(
+        model,
+        ", ".join(headphone_models(root))
+      ))
+  return paths
+
+def compensation_filter(model, length=512, minimum=True, root=HRTF_ROOT):
+  """
+  @brief      { Builds the (left, right) compensation filter of a model }
+
+  Opti ships ready made inverses of the loudspeaker. The headphones ship
+  their measured responses, which are inverted here with a regularized
+  magnitude (at most INVERSE_RANGE dB of boost) and made causal.
+
+  @param      model    a name from headphone_models()
+  @param      length   The length of the filter
+  @param      minimum  Minimum phase, otherwise linear phase (adds delay)
+  @param      root     The dataset directory
+
+  @return     { (float32 array shaped (2, length), list of source files) }
+  """
+  paths = compensation_sources(model, minimum, root)
+
+  if model == "Opti":
+    response = read_raw(paths[0]) / 32768.0
+    if not minimum:
+      # centre the linear phase inverse on the kept samples
+      peak = np.argmax(np.abs(response))
+      response = response[max(0, peak - length // 2):]
+    filters = np.stack([response, response])
+    return fade_out(filters, length).astype(np.float32), paths
+
+  responses = np.stack([read_raw(path) / 32768.0 for path in paths])
+  fft_size = 1 << int(np.ceil(np.log2(responses.shape[1])))
+  magnitude = np.abs(np.fft.rfft(responses, n=fft_size, axis=-1))
+
+  floor = magnitude.max(axis=-1, keepdims=True) * 10 ** (-INVERSE_RANGE / 20)
+  inverse = magnitude / (magnitude ** 2 + floor ** 2)
+  # unity gain in the middle of the band
+  frequencies = np.fft.rfftfreq(fft_size)
+  band = (frequencies > 0.005) & (frequencies < 0.18)
+  inverse /= np.median(inverse[:, band], axis=-1, keepdims=True)
+
+  if minimum:
+    filters = np.stack([minimum_phase(ear, fft_size) for ear in inverse])
+  else:
+    filters = np.roll(np.fft.irfft(inverse, n=fft_size), length // 2, axis=-1)
+  return fade_out(filters, length).astype(np.float32), paths
+
+def round_half_down(value):
+  """
+  @brief      { Rounds to the nearest integer, ties go to the lower one }
+
+  @param      value  scalar or array
+
+  @return     { integer array, ties go to the lower integer }
+  """
+  return np.ceil(np.asarray(value, dtype=np.float64) - 0.5).astype(np.int64)
+
+def unit_vectors(elevation, azimuth):
+  """
+  @brief      { Converts directions in degrees to points on the unit sphere }
+
+  @param      elevation  scalar or array of elevations
+  @param      azimuth    scalar or array of azimuths
+
+  @return     { array shaped (..., 3) }
+  """
+  elevation = np.deg2rad(np.asarray(elevation, dtype=np.float64))
+  azimuth = np.deg2rad(np.asarray(azimuth, dtype=np.float64))
+  return np.stack([
+    np.cos(elevation) * np.cos(azimuth),
+    np.cos(elevation) * np.sin(azimuth),
+    np.sin(elevation)
+  ], axis=-1)
+
+class HRTFBank(object):
+  """
+  @brief      { All of the hrtfs packed in one contiguous float32 tensor }
+
+  filters has shape (side, direction, taps) with side 0 = L and 1 = R.
+  Row i of every side was measured at (elevations[i], azimuths[i]).
+  The experiment renders the right ear with the left ear filter of the
+  mirrored direction, taken from side right_side (see ears()).
+  A minimum phase bank (see minimum_phased()) keeps the delay each filter
+  was stripped of in delays, shaped (side, direction), in samples.
+  grid maps a 1 degree (elevation, azimuth) cell to the measured row, or
+  -1 if nothing was measured there, nearest maps every cell to the row
+  measured closest to it on the sphere.
+  """
+
+  SIDES = ('L', 'R')
+  MIN_ELEVATION = -40
+  MAX_ELEVATION = 90
+  ELEVATION_STEP = 1
+  AZIMUTH_STEP = 1
+
+  def __init__(self, filters, elevations, azimuths, nearest=None,
+               right_side=0, fs=NATIVE_RATE, delays=None):
+    self.filters = np.ascontiguousarray(filters, dtype=np.float32)
+    self.delays = None if delays is None else np.asarray(
+      delays,
+      dtype=np.float32
+    )
+    self.right_side = right_side
+    self.fs = fs
+    # set when the bank is mapped from the disk cache
+    self.root = None
+    self.name = None
+    self.sources = list()
+    self._rates = dict()
+    self.elevations = np.asarray(elevations, dtype=np.int64)
+    self.azimuths = np.asarray(azimuths, dtype=np.int64)
+    self.taps = self.filters.shape[2]
+    self._spectra = dict()
+    self._build_index(nearest)
+
+  @classmethod
+  def load(cls, root=HRTF_ROOT, workers=8):
+    """
+    @brief      { Reads the dataset straight into a bank }
+
+    @param      root     The dataset directory
+    @param      workers  Number of threads reading files in parallel
+
+    @return     { HRTFBank }
+    """
+    entries, responses = read_all(root, workers, np.float32)
+    rows = dict()
+    for index, (side, elevation, azimuth, _) in enumerate(entries):
+      rows.setdefault((elevation, azimuth), dict())[side] = index
+
+    directions = sorted(rows.keys())
+    for direction in directions:
+      if len(rows[direction]) != len(cls.SIDES):
+        raise ValueError("direction {} is missing an ear".format(direction))
+
+    order = [[rows[d][side] for d in directions] for side in cls.SIDES]
+    return cls(
+      responses[np.array(order)],
+      [d[0] for d in directions],
+      [d[1] for d in directions]
+    )
+
+  @classmethod
+  @instrument.timed("hrtf.open")
+  def _open_cached(cls, build, root, name, sources=(), rebuild=False):
+    """
+    @brief      { Maps a compiled bank, calling build() to compile it first }
+
+    @param      build    returns the bank when the compiled one is stale
+    @param      root     The dataset directory
+    @param      name     The name of the bank, one per derived variant
+    @param      sources  Other files the bank is derived from
+    @param      rebuild  Recompile even if the manifest still matches
+
+    @return     { HRTFBank that remembers where it is cached }
+    """
+    compiled = None if rebuild else open_compiled(root, name, sources)
+    if compiled is None:
+      bank = build()
+      try:
+        compile_bank(bank, root, name=name, sources=sources)
+        compiled = open_compiled(root, name, sources)
+      except (IOError, OSError):
+        # read only dataset, keep the bank in memory
+        compiled = None
+    if compiled is not None:
+      bank = cls(**compiled)
+
+    bank.root = root
+    bank.name = name
+    bank.sources = list(sources)
+    instrument.gauge("hrtf.{}.bytes".format(name), bank.nbytes)
+    return bank
+
+  @classmethod
+  def open(cls, root=HRTF_ROOT, workers=8, rebuild=False):
+    """
+    @brief      { Maps the compiled bank, compiling it first if needed }
+
+    The filters are a read only memory map, so every process using the
+    same dataset shares the same pages.
+
+    @param      root     The dataset directory
+    @param      workers  Number of threads reading files if rebuilding
+    @param      rebuild  Recompile even if the manifest still matches
+
+    @return     { HRTFBank }
+    """
+    return cls._open_cached(
+      lambda: cls.load(root, workers),
+      root,
+      CACHE_NAME,
+      rebuild=rebuild
+    )
+
+  @classmethod
+  def open_compensated(cls, model, length=512, minimum=True,
+                       root=HRTF_ROOT, workers=8, rebuild=False):
+    """
+    @brief      { Maps a bank with headphone compensation folded in }
+
+    The derived bank is compiled next to the plain one the first time and
+    invalidated with it or with the compensation files.
+
+    @param      model    a name from headphone_models()
+    @param      length   The length of the compensation filter
+    @param      minimum  Minimum phase compensation
+    @param      root     The dataset directory
+    @param      workers  Number of threads reading files if rebuilding
+    @param      rebuild  Recompile even if the manifest still matches
+
+    @return     { HRTFBank }
+    """
+    name = "{}-{}-{}{}".format(
+      CACHE_NAME,
+      model,
+      length,
+      "-minphase" if minimum else ""
+    )
+    # the filter itself is only built when the cached bank is stale
+    sources = compensation_sources(model, minimum, root)
+
+    return cls._open_cached(
+      lambda: cls.open(root, workers, rebuild).compensated(
+        compensation_filter(model, length, minimum, root)[0]
+      ),
+      root,
+      name,
+      sources,
+      rebuild
+    )
+
+  @classmethod
+  def open_minimum_phase(cls, taps=128, root=HRTF_ROOT, workers=8,
+                         rebuild=False):
+    """
+    @brief      { Maps a bank of truncated minimum phase filters and delays }
+
+    The saving is modest and the price is accuracy. At 64 taps a render of
+    ping.wav takes about 2.9 ms instead of 3.7 ms with the full filters, at
+    a median magnitude error of 14% of the peak below 80% of Nyquist (9% at
+    128 taps, which renders no faster), see
+    python hrtf.py --minphase 64 128 --report FILE. The full bank stays the
+    default.
+
+    @param      taps     length of the minimum phase filters
+    @param      root     The dataset directory
+    @param      workers  Number of threads reading files if rebuilding
+    @param      rebuild  Recompile even if the manifest still matches
+
+    @return     { HRTFBank with delays }
+    """
+    return cls._open_cached(
+      lambda: cls.open(root, workers, rebuild).minimum_phased(taps),
+      root,
+      "{}-minphase-{}".format(CACHE_NAME, taps),
+      rebuild=rebuild
+    )
+
+  def at_rate(self, fs):
+    """
+    @brief      { The same bank resampled to another sample rate }
+
+    Each rate is resampled once and kept in memory, and on disk next to
+    this bank if this bank came from the disk cache, so rendering at any
+    rate costs the same as at the native rate after the first request.
+
+    @param      fs    The sample rate, None for the native one
+
+    @return     { HRTFBank at fs }
+    """
+    if fs is None or fs == self.fs:
+      return self
+    fs = int(fs)
+    if fs not in self._rates:
+      if self.name is None:
+        bank = self.resampled(fs)
+      else:
+        bank = HRTFBank._open_cached(
+          lambda: self.resampled(fs),
+          self.root,
+          "{}-{}".format(self.name, fs),
+          self.sources
+        )
+      self._rates[fs] = bank
+    return self._rates[fs]
+
+  def resampled(self, fs):
+    """
+    @brief      { Resamples every filter with a polyphase filter }
+
+    The taps are scaled by self.fs / fs, so the magnitude response is kept
+    rather than the sample values. Checked against RESAMPLE_TOLERANCE.
+    The resampler rings before the first tap, so minimum phase filters are
+    resampled with their delays put back and split again.
+
+    @param      fs    The sample rate
+
+    @return     { HRTFBank at fs }
+    """
+    if self.delays is not None:
+      return self.delayed().resampled(fs).minimum_phased(
+        int(round(self.taps * float(fs) / self.fs))
+      )
+
+    divisor = gcd(int(fs), int(self.fs))
+    # room for the anti-aliasing filter to ring out past the last tap
+    padding = int(np.ceil(10.0 * self.fs / fs)) + 1
+    filters = resample_poly(
+      np.pad(self.filters, ((0, 0), (0, 0), (0, padding)), mode="constant"),
+      int(fs) // divisor,
+      int(self.fs) // divisor,
+      axis=-1
+    ) * (float(self.fs) / fs)
+
+    bank = HRTFBank(
+      filters,
+      self.elevations,
+      self.azimuths,
+      self.nearest,
+      self.right_side,
+      fs,
+      None if self.delays is None else self.delays * (float(fs) / self.fs)
+    )
+
+    error = self.spectral_error(bank)
+    if error > RESAMPLE_TOLERANCE:
+      raise ValueError("resampling to {} Hz is off by {:.4f}".format(
+        fs,
+        error
+      ))
+    return bank
+
+  def spectral_error(self, other, band=RESAMPLE_BAND):
+    """
+    @brief      { Compares the spectra of two banks at different rates }
+
+    Both are transformed so that their bins land on the same frequencies.
+
+    @param      other  HRTFBank with the same directions
+    @param      band   fraction of the lower Nyquist frequency compared
+
+    @return     { largest error relative to the peak of each spectrum }
+    """
+    step = gcd(int(self.fs), int(other.fs))
+    scale = -(-4096 * step // int(self.fs))
+    sizes = [scale * int(bank.fs) // step for bank in (self, other)]
+
+    bins = int(band * min(sizes) / 2)
+    mine, theirs = [
+      np.fft.rfft(bank.filters, n=size, axis=-1)[..., 1:bins]
+      for bank, size in zip((self, other), sizes)
+    ]
+    peak = np.abs(mine).max(axis=-1, keepdims=True)
+    return float(np.max(np.abs(theirs - mine) / peak))
+
+  def _build_index(self, nearest=None):
+    n_elevations = (
+      (self.MAX_ELEVATION - self.MIN_ELEVATION) // self.ELEVATION_STEP + 1
+    )
+    n_azimuths = 360 // self.AZIMUTH_STEP
+
+    self.grid = np.full((n_elevations, n_azimuths), -1, dtype=np.int32)
+    self.grid[
+      self._elevation_cell(self.elevations),
+      self._azimuth_cell(self.azimuths)
+    ] = np.arange(len(self.elevations))
+
+    # nearest measured direction on the sphere for every cell, found with a
+    # kd-tree on unit vectors (chord length orders like great-circle
+    # distance), so the azimuth wraps around and the ring spacing is
+    # taken into account
+    self.tree = cKDTree(unit_vectors(self.elevations, self.azimuths))
+
+    if nearest is not None and nearest.shape == self.grid.shape:
+      # already solved when the bank was compiled
+      self.nearest = nearest
+    else:
+      self.nearest = self._solve_nearest()
+
+    # the experiment mirrors the left ear to get the right one
+    self.mirror = self.nearest[
+      self._elevation_cell(self.elevations),
+      self._azimuth_cell((360 - self.azimuths) % 360)
+    ]
+
+  def _solve_nearest(self):
+    n_elevations, n_azimuths = self.grid.shape
+    cell_elevations, cell_azimuths = np.meshgrid(
+      self.MIN_ELEVATION + np.arange(n_elevations) * self.ELEVATION_STEP,
+      np.arange(n_azimuths) * self.AZIMUTH_STEP,
+      indexing="ij"
+    )
+    _, nearest = self.tree.query(
+      unit_vectors(cell_elevations.ravel(), cell_azimuths.ravel())
+    )
+    return nearest.astype(np.int32).reshape(self.grid.shape)
+
+  def _elevation_cell(self, elevation):
+    elevation = np.clip(elevation, self.MIN_ELEVATION, self.MAX_ELEVATION)
+    return round_half_down(
+      (elevation - self.MIN_ELEVATION) / float(self.ELEVATION_STEP)
+    )
+
+  def _azimuth_cell(self, azimuth):
+    cells = 360 // self.AZIMUTH_STEP
+    return round_half_down(
+      np.mod(azimuth, 360) / float(self.AZIMUTH_STEP)
+    ) % cells
+
+  def index(self, elevation, azimuth):
+    """
+    @brief      { Finds the row measured at exactly this direction }
+
+    @param      elevation  scalar or array of elevations
+    @param      azimuth    scalar or array of azimuths
+
+    @return     { row(s) in filters, -1 where nothing was measured }
+    """
+    return self.grid[
+      self._elevation_cell(elevation),
+      self._azimuth_cell(azimuth)
+    ]
+
+  @instrument.timed("hrtf.lookup")
+  def lookup(self, elevation, azimuth):
+    """
+    @brief      { Finds the row of the closest measured direction }
+
+    Closest by great-circle distance, resolved to the nearest 1 degree cell.
+    The cost does not depend on how many directions were measured.
+
+    @param      elevation  scalar or array of elevations
+    @param      azimuth    scalar or array of azimuths
+
+    @return     { row(s) in filters }
+    """
+    return self.nearest[
+      self._elevation_cell(elevation),
+      self._azimuth_cell(azimuth)
+    ]
+
+  def triangulation(self):
+    """
+    @brief      { Triangles between the measured directions on the sphere }
+
+    The convex hull of the unit vectors, computed once. Each triangle keeps
+    the inverse of its vertex matrix, so barycentric weights of a direction
+    are a single matrix product, and every row lists the triangles that
+    touch it (padded with -1).
+
+    @return     { (triangles (T, 3), inverses (T, 3, 3), incident (rows, D)) }
+    """
+    if "triangulation" not in self._spectra:
+      vertices = unit_vectors(self.elevations, self.azimuths)
+      triangles = ConvexHull(vertices).simplices
+      inverses = np.linalg.inv(
+        np.transpose(vertices[triangles], (0, 2, 1))
+      )
+
+      touching = [list() for _ in range(len(vertices))]
+      for index, triangle in enumerate(triangles):
+        for row in triangle:
+          touching[row].append(index)
+      incident = np.full(
+        (len(vertices), max(len(t) for t in touching)),
+        -1,
+        dtype=np.int64
+      )
+      for row, found in enumerate(touching):
+        incident[row, :len(found)] = found
+
+      self._spectra["triangulation"] = (triangles, inverses, incident)
+    return self._spectra["triangulation"]
+
+  def barycentric(self, elevation, azimuth):
+    """
+    @brief      { Finds the triangle around each direction and its weights }
+
+    @param      elevation  scalar or array of elevations
+    @param      azimuth    scalar or array of azimuths
+
+    @return     { (rows shaped (n, 3), weights shaped (n, 3) summing to 1) }
+    """
+    triangles, inverses, incident = self.triangulation()
+    elevation = np.clip(elevation, self.MIN_ELEVATION, self.MAX_ELEVATION)
+    elevation, azimuth = np.broadcast_arrays(elevation, azimuth)
+    directions = unit_vectors(elevation, azimuth).reshape(-1, 3)
+
+    # the enclosing triangle nearly always touches the nearest measurement
+    candidates = incident[self.lookup(elevation, azimuth).ravel()]
+    best, chosen = self._enclosing(
+      directions,
+      np.clip(candidates, 0, None),
+      candidates >= 0
+    )
+
+    # fall back to every triangle for the few that were missed
+    missed = np.flatnonzero(chosen.min(axis=1) < -1e-9)
+    if len(missed):
+      every = np.broadcast_to(
+        np.arange(len(triangles)),
+        (len(missed), len(triangles))
+      )
+      best[missed], chosen[missed] = self._enclosing(
+        directions[missed],
+        every,
+        np.ones(every.shape, dtype=bool)
+      )
+
+    return triangles[best], chosen / chosen.sum(axis=1, keepdims=True)
+
+  def _enclosing(self, directions, candidates, valid):
+    _, inverses, _ = self.triangulation()
+    weights = np.einsum("ndij,nj->ndi", inverses[candidates], directions)
+    # the enclosing triangle is the one with no negative weight, picking
+    # the largest minimum also covers directions on an edge
+    score = np.where(valid, weights.min(axis=2), -np.inf)
+    pick = np.argmax(score, axis=1)
+    index = np.arange(len(directions))
+    return candidates[index, pick], weights[index, pick]
+
+  def onsets(self):
+    """
+    @brief      { Sample where each filter starts, computed once }
+
+    @return     { int array shaped (side, direction) }
+    """
+    if "onsets" not in self._spectra:
+      magnitude = np.abs(self.filters)
+      peak = magnitude.max(axis=2, keepdims=True)
+      self._spectra["onsets"] = np.argmax(
+        magnitude >= ONSET_THRESHOLD * peak,
+        axis=2
+      )
+    return self._spectra["onsets"]
+
+  def interpolate(self, elevation, azimuth, side=0, align=True):
+    """
+    @brief      { Blends the three filters around each direction }
+
+    With align the filters are shifted to a common onset before they are
+    blended and the result is moved to the weighted onset, so the three
+    delays do not comb filter each other. Minimum phase filters all start
+    at the first tap and are blended as they are, their delays are blended
+    by delay().
+
+    @param      elevation  scalar or array of elevations
+    @param      azimuth    scalar or array of azimuths
+    @param      side       0 = L, 1 = R, or an array broadcast against the
+                           directions shaped (n, 1)
+    @param      align      Time align the filters before blending
+
+    @return     { float32 array shaped (n, taps) }
+    """
+    rows, weights = self.barycentric(elevation, azimuth)
+    filters = self.filters[side, rows]
+
+    if not align or self.delays is not None:
+      return np.einsum("nk,nkt->nt", weights, filters).astype(np.float32)
+
+    onsets = self.onsets()[side, rows]
+    target = round_half_down(np.sum(weights * onsets, axis=1))
+    shifts = target[:, np.newaxis] - onsets
+
+    # shifting by indexing: tap t of the output reads tap t - shift
+    taps = np.arange(self.taps)
+    source = taps[np.newaxis, np.newaxis, :] - shifts[:, :, np.newaxis]
+    valid = (source >= 0) & (source < self.taps)
+    shifted = np.where(
+      valid,
+      np.take_along_axis(filters, np.clip(source, 0, self.taps - 1), axis=2),
+      0
+    )
+    return np.einsum("nk,nkt->nt", weights, shifted).astype(np.float32)
+
+  def delay(self, elevation, azimuth, side=0):
+    """
+    @brief      { Blends the delays of the three filters around a direction }
+
+    @param      elevation  scalar or array of elevations
+    @param      azimuth    scalar or array of azimuths
+    @param      side       0 = L, 1 = R, or an array shaped (n, 1)
+
+    @return     { delays in samples shaped (n,) }
+    """
+    rows, weights = self.barycentric(elevation, azimuth)
+    return np.sum(weights * self.delays[side, rows], axis=1)
+
+  def compensated(self, compensation, taps=None):
+    """
+    @brief      { Folds a (left, right) compensation filter into the bank }
+
+    Side 0 becomes the left ear filters convolved with the left
+    compensation, side 1 the left ear filters convolved with the right one,
+    since the right ear is rendered from the mirrored left ear. Renders then
+    cost the same as without compensation.
+
+    @param      compensation  array shaped (2, length)
+    @param      taps          length of the folded filters, defaults to taps
+
+    @return     { HRTFBank with right_side = 1 }
+    """
+    taps = self.taps if taps is None else taps
+    length = self.taps + compensation.shape[1] - 1
+    fft_size = 1 << int(np.ceil(np.log2(length)))
+
+    left = np.fft.rfft(self.filters[0], n=fft_size, axis=-1)
+    folded = np.fft.irfft(
+      left[np.newaxis] * np.fft.rfft(compensation, n=fft_size)[:, np.newaxis],
+      n=fft_size,
+      axis=-1
+    )
+    return HRTFBank(
+      fade_out(folded, taps),
+      self.elevations,
+      self.azimuths,
+      self.nearest,
+      right_side=1,
+      fs=self.fs,
+      delays=self.delays
+    )
+
+  def minimum_phased(self, taps=128):
+    """
+    @brief      { Splits every filter into a minimum phase filter and a delay }
+
+    The minimum phase filter has the magnitude response of the measured
+    one with all of its energy packed at the start, so it survives being
+    cut to a few taps. The delay is the lag that best lines it up with the
+    measured filter, to a fraction of a sample, and is applied by the
+    renderer as a shift (see fractional_delay()).
+
+    @param      taps  length of the minimum phase filters
+
+    @return     { HRTFBank with delays }
+    """
+    if self.delays is not None:
+      raise ValueError("the bank is already minimum phase")
+
+    # a long transform keeps the cepstrum from aliasing
+    fft_size = 4 << int(np.ceil(np.log2(self.taps)))
+    spectrum = np.fft.rfft(self.filters, n=fft_size, axis=-1)
+    minimum = minimum_phase(np.abs(spectrum), fft_size)
+
+    # peak of the cross correlation, refined with a parabola through it
+    correlation = np.fft.irfft(
+      spectrum * np.conj(np.fft.rfft(minimum, axis=-1)),
+      n=fft_size,
+      axis=-1
+    )[..., :self.taps]
+    lag = np.clip(np.argmax(correlation, axis=-1), 1, self.taps - 2)
+    before, peak, after = [
+      np.take_along_axis(correlation, (lag + offset)[..., np.newaxis], -1)
+      for offset in (-1, 0, 1)
+    ]
+    curvature = before - 2 * peak + after
+    delays = lag + np.where(
+      curvature < 0,
+      0.5 * (before - after) / np.where(curvature < 0, curvature, -1),
+      0
+    )[..., 0]
+
+    return HRTFBank(
+      fade_out(minimum, taps),
+      self.elevations,
+      self.azimuths,
+      self.nearest,
+      self.right_side,
+      self.fs,
+      delays
+    )
+
+  def split(self):
+    """
+    @brief      { The filters with the fraction of their delays folded in }
+
+    Computed once, so renderers are left with whole sample shifts.
+
+    @return     { (HRTFBank of taps + DELAY_TAPS long filters, int shifts
+                  shaped (side, direction)) }
+    """
+    if "split" not in self._spectra:
+      filters, shifts = split_delays(self.filters, self.delays)
+      self._spectra["split"] = (
+        HRTFBank(
+          filters,
+          self.elevations,
+          self.azimuths,
+          self.nearest,
+          self.right_side,
+          self.fs
+        ),
+        shifts
+      )
+    return self._spectra["split"]
+
+  def delayed(self):
+    """
+    @brief      { The same bank with the delays put back into the filters }
+
+    For renderers that cannot shift their output, such as the partitioned
+    stream convolution. The filters grow by delay_room taps at most.
+
+    @return     { HRTFBank without delays, self if it has none }
+    """
+    if self.delays is None:
+      return self
+    if "delayed" not in self._spectra:
+      self._spectra["delayed"] = HRTFBank(
+        fractional_delay(self.filters, self.delays, self.delay_room),
+        self.elevations,
+        self.azimuths,
+        self.nearest,
+        self.right_side,
+        self.fs
+      )
+    return self._spectra["delayed"]
+
+  def decomposition_error(self, original, band=RESAMPLE_BAND):
+    """
+    @brief      { How far a minimum phase bank is from the measured one }
+
+    @param      original  HRTFBank the minimum phase one was made from
+    @param      band      fraction of the Nyquist frequency compared
+
+    @return     { (magnitude, response) errors relative to the peak of each
+                  spectrum, shaped (side, direction); magnitude leaves out
+                  the phase, response includes the delay and the excess
+                  phase the decomposition drops }
+    """
+    rebuilt = self.delayed()
+    fft_size = 2 << int(np.ceil(np.log2(max(rebuilt.taps, original.taps))))
+    bins = int(band * fft_size / 2)
+    mine, theirs = [
+      np.fft.rfft(bank.filters, n=fft_size, axis=-1)[..., 1:bins]
+      for bank in (rebuilt, original)
+    ]
+    peak = np.abs(theirs).max(axis=-1)
+    return (
+      np.max(np.abs(np.abs(mine) - np.abs(theirs)), axis=-1) / peak,
+      np.max(np.abs(mine - theirs), axis=-1) / peak
+    )
+
+  def ears(self, rows):
+    """
+    @brief      { Index of the (left, right) filter pair of each row }
+
+    @param      rows  row or array of rows, e.g. from lookup()
+
+    @return     { index into filters, spectra() or partitions(), the pair
+                  is the axis after the shape of rows }
+    """
+    rows = np.asarray(rows)
+    return (
+      np.array([0, self.right_side]),
+      np.stack([rows, self.mirror[rows]], axis=-1)
+    )
+
+  def spectra(self, fft_size):
+    """
+    @brief      { Real FFTs of every filter, computed once per fft size }
+
+    @param      fft_size  The transform length, at least taps
+
+    @return     { complex64 array shaped (side, direction, fft_size // 2 + 1) }
+    """
+    if fft_size not in self._spectra:
+      if fft_size < self.taps:
+        raise ValueError("fft size {} is shorter than the {} taps".format(
+          fft_size,
+          self.taps
+        ))
+      self._spectra[fft_size] = np.fft.rfft(
+        self.filters,
+        n=fft_size,
+        axis=-1
+      ).astype(np.complex64)
+    return self._spectra[fft_size]
+
+  def partitions(self, block):
+    """
+    @brief      { Filters cut into block long partitions and transformed }
+
+    Used by uniformly partitioned overlap-save, computed once per block size.
+
+    @param      block  The partition length
+
+    @return     { complex64 array shaped (side, direction, partition, block + 1) }
+    """
+    key = ("partitions", block)
+    if key not in self._spectra:
+      n_partitions = -(-self.taps // block)
+      padded = np.zeros(
+        self.filters.shape[:2] + (n_partitions * block,),
+        dtype=np.float32
+      )
+      padded[..., :self.taps] = self.filters
+      self._spectra[key] = np.fft.rfft(
+        padded.reshape(self.filters.shape[:2] + (n_partitions, block)),
+        n=2 * block,
+        axis=-1
+      ).astype(np.complex64)
+    return self._spectra[key]
+
+  def to_dict(self):
+    """
+    @brief      { Unpacks the bank into the load_hrtf() structure }
+
+    @return     { nested dict of views into filters }
+    """
+    hrtf = dict()
+    for side_index, side in enumerate(self.SIDES):
+      hrtf[side] = dict()
+      for row, (elevation, azimuth) in enumerate(
+        zip(self.elevations, self.azimuths)
+      ):
+        hrtf[side].setdefault(int(elevation), dict())[int(azimuth)] = (
+          self.filters[side_index, row]
+        )
+    return hrtf
+
+  @property
+  def delay_room(self):
+    """
+    @brief      { Samples a render grows by when the delays are applied }
+    """
+    return 0 if self.delays is None else delay_room(self.delays)
+
+  @property
+  def nbytes(self):
+    return self.filters.nbytes
+
+  def __len__(self):
+    return self.filters.shape[1]
+
+if __name__ == '__main__':
+  # python hrtf.py [root] [--minphase TAPS ...]: compile the bank next to the
+  # dataset, and the minimum phase banks with their error report
+  import argparse
+  from time import time
+
+  parser = argparse.ArgumentParser(description="Compile the KEMAR bank")
+  parser.add_argument("root", nargs="?", default=HRTF_ROOT,
+                      help="dataset directory")
+  parser.add_argument("--minphase", type=int, nargs="*", default=[],
+                      help="also compile minimum phase banks of these lengths")
+  parser.add_argument("--report", default=None,
+                      help="csv file for the error of every direction")
+  args = parser.parse_args()
+
+  start = time()
+  bank = HRTFBank.open(args.root, rebuild=True)
+  print("compiled {} in {:.3f} s".format(bank.name, time() - start))
+
+  rows = list()
+  for taps in args.minphase:
+    start = time()
+    split = HRTFBank.open_minimum_phase(taps, args.root, rebuild=True)
+    magnitude, response = split.decomposition_error(bank)
+    print("compiled {} in {:.3f} s".format(split.name, time() - start))
+    print("  error    median    95%      max   worst direction")
+    for label, error in (("magnitude", magnitude), ("response", response)):
+      side, row = np.unravel_index(np.argmax(error), error.shape)
+      print("  {:9s} {:.4f}  {:.4f}  {:.4f}  {} {:+d}e{:03d}a".format(
+        label,
+        np.median(error),
+        np.percentile(error, 95),
+        error.max(),
+        HRTFBank.SIDES[side],
+        bank.elevations[row],
+        bank.azimuths[row]
+      ))
+    for side, name in enumerate(HRTFBank.SIDES):
+      for row in range(len(bank)):
+        rows.append((
+          taps,
+          name,
+          bank.elevations[row],
+          bank.azimuths[row],
+          split.delays[side, row],
+          magnitude[side, row],
+          response[side, row]
+        ))
+
+  if args.report is not None:
+    with open(args.report, "w") as f:
+      f.write("taps,side,elevation,azimuth,delay,magnitude,response\n")
+      for row in rows:
+        f.write("{},{},{},{},{:.3f},{:.5f},{:.5f}\n".format(*row))
@@ -0,0 +1,268 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Counters, timers and memory peaks of the hot paths, off by default
+#
+###############################################################################
+
+from time import perf_counter
+import functools
+import math
+import sys
+import threading
+
+# nothing is recorded until enable(), a wrapped call then costs one check
+ENABLED = False
+
+# histograms count calls by power of two microseconds
+BUCKETS = 32
+
+class Timer(object):
+  """
+  @brief      { Calls, total seconds and a latency histogram of one name }
+  """
+
+  def __init__(self):
+    self.calls = 0
+    self.total = 0.0
+    self.worst = 0.0
+    self.histogram = [0] * BUCKETS
+    self.peak = 0
+
+  def add(self, seconds):
+    self.calls += 1
+    self.total += seconds
+    self.worst = max(self.worst, seconds)
+    bucket = int(math.log(max(seconds * 1e6, 1), 2))
+    self.histogram[min(bucket, BUCKETS - 1)] += 1
+
+  def quantile(self, q):
+    """
+    @brief      { Upper edge of the bucket holding quantile q, in seconds }
+    """
+    seen = 0
+    for bucket, count in enumerate(self.histogram):
+      seen += count
+      if seen >= q * self.calls:
+        return min(2 ** (bucket + 1) / 1e6, self.worst)
+    return self.worst
+
+class Registry(object):
+  """
+  @brief      { Everything recorded since enable() }
+  """
+
+  def __init__(self, memory=False):
+    self.memory = memory
+    self.timers = dict()
+    self.counters = dict()
+    self.gauges = dict()
+    # reentrant, the summary may be asked for by a signal arriving while
+    # the main thread is recording
+    self.lock = threading.RLock()
+    self.started = perf_counter()
+
+  def timer(self, name):
+    if name not in self.timers:
+      self.timers[name] = Timer()
+    return self.timers[name]
+
+  def summary(self):
+    """
+    @brief      { Formats what was recorded as a table }
+
+    @return     { string }
+    """
+    lines = ["instrumented for {:.3f} s".format(perf_counter() - self.started)]
+    if self.timers:
+      lines.append("{:28s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}{}".format(
+        "timer", "calls", "total s", "mean ms", "p99 ms", "max ms",
+        " {:>10s}".format("peak MB") if self.memory else ""
+      ))
+    with self.lock:
+      for name, timer in sorted(self.timers.items()):
+        lines.append(
+          "{:28s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f}{}".format(
+            name,
+            timer.calls,
+            timer.total,
+            timer.total / max(timer.calls, 1) * 1000,
+            timer.quantile(0.99) * 1000,
+            timer.worst * 1000,
+            " {:10.2f}".format(timer.peak / 1e6) if self.memory else ""
+          )
+        )
+      for name, count in sorted(self.counters.items()):
+        lines.append("{:28s} {:8d}".format(name, count))
+      for name, value in sorted(self.gauges.items()):
+        lines.append("{:28s} {}".format(name, value))
+    if self.memory:
+      import tracemalloc
+
+      current, peak = tracemalloc.get_traced_memory()
+      lines.append("traced memory {:.2f} MB, peak {:.2f} MB".format(
+        current / 1e6,
+        peak / 1e6
+      ))
+    return "\n".join(lines) + "\n"
+
+registry = None
+
+def enable(memory=False):
+  """
+  @brief      { Starts recording }
+
+  @param      memory  Also trace allocations with tracemalloc, which slows
+                      every allocation down while it runs
+  """
+  global ENABLED, registry
+
+  registry = Registry(memory)
+  if memory:
+    import tracemalloc
+
+    tracemalloc.start()
+  ENABLED = True
+
+def disable():
+  global ENABLED
+
+  ENABLED = False
+  if registry is not None and registry.memory:
+    import tracemalloc
+
+    tracemalloc.stop()
+
+def timed(name):
+  """
+  @brief      { Decorator recording calls of a function under name }
+
+  Nested timed calls each count their own time. With memory tracing on,
+  the peak traced memory during a call, above what was traced before it,
+  is kept as the peak of the name. A timed call inside another one resets
+  the peak of the outer call, so peaks are only exact for the innermost.
+  Before Python 3.9 the growth of traced memory over the call is kept
+  instead.
+  """
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not ENABLED:
+        return function(*args, **kwargs)
+      return call(name, function, args, kwargs)
+    return wrapper
+  return decorate
+
+def call(name, function, args, kwargs):
+  memory = registry.memory
+  if memory:
+    import tracemalloc
+
+    before = tracemalloc.get_traced_memory()[0]
+    # before Python 3.9 the peak cannot be reset, what the call left
+    # allocated is the best that can be done
+    reset = hasattr(tracemalloc, "reset_peak")
+    if reset:
+      tracemalloc.reset_peak()
+  start = perf_counter()
+  try:
+    return function(*args, **kwargs)
+  finally:
+    elapsed = perf_counter() - start
+    with registry.lock:
+      timer = registry.timer(name)
+      timer.add(elapsed)
+      if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        timer.peak = max(timer.peak, (peak if reset else current) - before)
+
+def observe(name, seconds):
+  """
+  @brief      { Adds a latency measured elsewhere to the timer of name }
+  """
+  if not ENABLED:
+    return
+  with registry.lock:
+    registry.timer(name).add(seconds)
+
+def count(name, n=1):
+  if not ENABLED:
+    return
+  with registry.lock:
+    registry.counters[name] = registry.counters.get(name, 0) + n
+
+def gauge(name, value):
+  """
+  @brief      { Keeps the last value of name, e.g. the size of the bank }
+  """
+  if not ENABLED:
+    return
+  with registry.lock:
+    registry.gauges[name] = value
+
+def dump(path):
+  """
+  @brief      { Appends the summary to path, - for stderr }
+  """
+  if registry is None:
+    return
+  if path == "-":
+    sys.stderr.write(registry.summary())
+    return
+  with open(path, "a") as f:
+    f.write(registry.summary())
+
+def dump_on_signal(path, signum=None):
+  """
+  @brief      { Appends the summary to path whenever signum arrives }
+
+  @param      path    file, or - for stderr
+  @param      signum  The signal, SIGUSR1 by default
+  """
+  import signal
+
+  if signum is None:
+    signum = signal.SIGUSR1
+  signal.signal(signum, lambda *_: dump(path))
+
+def profiled(function, path, *args, **kwargs):
+  """
+  @brief      { Runs a function under cProfile and saves the stats }
+
+  The pstats file loads in snakeviz, or flameprof for a flame graph.
+
+  @param      function  The function
+  @param      path      where the stats are written
+
+  @return     { what function returned }
+  """
+  import cProfile
+
+  profile = cProfile.Profile()
+  try:
+    return profile.runcall(function, *args, **kwargs)
+  finally:
+    profile.dump_stats(path)
+
+if __name__ == '__main__':
+  # python instrument.py [--memory], times a load, lookups and a render
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Instrument one render")
+  parser.add_argument("--memory", action="store_true",
+                      help="trace allocations as well")
+  args = parser.parse_args()
+
+  # the hooks report to the imported module, not to __main__
+  import instrument
+  import numpy as np
+  from hrtf import HRTFBank
+  from render import convolve_stereo
+
+  instrument.enable(args.memory)
+  bank = HRTFBank.open()
+  for elevation in range(-40, 91, 10):
+    bank.lookup(elevation, 30)
+  convolve_stereo(np.random.RandomState(0).randn(44100), bank, 0, 30)
+  instrument.dump("-")
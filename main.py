@@ -4,185 +4,85 @@
 #
 ###############################################################################
 
-from struct import unpack
-from scipy.io import wavfile
-from scipy.signal import fftconvolve
-from numpy import convolve
-from time import sleep
-import os
-import wave
-import numpy as np
-import sounddevice as sd
-import soundfile as sf
-import curses
-import math
+import argparse
 import random
+import numpy as np
 
-def read_dat(side, elevation, azimuth):
-  """
-  @brief      { Reads am hrtf file for a given direction if one exists }
+from hrtf import HRTF_ROOT, HRTFBank
+from render import RenderCache, convolve_stereo, warm_spectra
+from sinks import StreamSink, open_sink
 
-  @param      side       L / R
-  @param      elevation  -40 to +90 by increments of 10
-  @param      azimuth    0 to 355 by increments of 5
+# how many trials may be rendered ahead of playback
+PREFETCH_DEPTH = 1
 
-  @return     { returns an array of the transfer data or None if one is not available }
-  """
-  dat = list()
+# headphone model to compensate for, see hrtf.headphone_models(), or None
+HEADPHONES = None
 
-  path = "full/elev{:01d}/{:s}{:01d}e{:03d}a.dat".format(
-  	elevation, 
-  	side, 
-  	elevation, 
-  	azimuth
-  )
+# degrees the cursor moves by on the response circle
+RESOLUTION = 10
 
-  if not os.path.exists(path):
-    return None
-  else:
-    with open(path, "rb") as f:
-      while True:
-        short = f.read(2)
-        if short:
-          # byte ordering must be in reverse: '!'
-          dat.append(float(unpack("!h", short)[0]) / 32768)
-        else:
-          break
-  return np.array(dat)
-
-def load_hrtf():
-  """
-  @brief      { Loads all the hrtfs available }
-
-  @return     { 
-    data structure for HRTF data:
-      elevation ranges from -40 to +90 in increments of 10
-      azimuth ranges from 0 to 355 in increments of 5
-      left and right
-    3D array of key value pairs:
- 
-    HRTF = {
-      L: {
-        -40 : {
-          0 : list(data),
-          .
-          .
-          .
-        },
-      .
-      .
-      .
-      },
-      R: {
-        .
-        .
-        .
-      }
-    }
- 
-  }
-  """
-  hrtf = dict()
-  hrtf['L'] = dict()
-  hrtf['R'] = dict()
-  for side in hrtf.keys():
-    for elevation in range(-40, 90, 10):
-      #  all of the elevations are there, just the azimuths get cut off
-      hrtf[side][elevation] = dict()
-      for azimuth in range(0, 355, 5):
-        response = read_dat(side, elevation, azimuth)
-        if response is not None:
-          hrtf[side][elevation][azimuth] = response
-
-  return hrtf
-
-def get_closest_key(keys, target):
-  """
-  @brief      { Gets the closest key }
-  
-  @param      keys    The keys
-  @param      target  The target
-  
-  @return     { The closest key }
-  """
-  return target if target in keys else min(
-  	keys, 
-  	key=lambda k: abs(k - target)
-  )
+# every session appends its trial events here, see events.py
+EVENT_LOG = "events.jsonl"
 
-def convolve_stereo(data, hrtf, elevation, azimuth):
+def open_bank(root=HRTF_ROOT, headphones=None, minphase=None):
   """
-  @brief      { performs the Fast Fourier Transform on the given array }
+  @brief      { Opens the bank the renders are made with }
 
-  @param      data       The data
-  @param      elevation  The requested elevation
-  @param      azimuth    The requested azimuth
+  @param      root        The dataset directory
+  @param      headphones  headphone model to compensate for, or None
+  @param      minphase    length of minimum phase filters, or None
 
-  @return     { stereo matrix ready to be played }
+  @return     { HRTFBank }
   """
-  if elevation > 90:
-  	elevation = 90
-  elif elevation < -40:
-  	elevation = -40
+  if headphones is not None and minphase is not None:
+    raise ValueError("headphone compensation and minimum phase filters "
+                     "cannot be combined")
+  if headphones is not None:
+    return HRTFBank.open_compensated(headphones, root=root)
+  if minphase is not None:
+    return HRTFBank.open_minimum_phase(minphase, root=root)
+  return HRTFBank.open(root)
+
+def resolution(text):
+  """
+  @brief      { Reads --resolution, refusing steps the circle cannot take }
 
-  if azimuth < 0:
-  	while azimuth < 0:
-  	  azimuth = azimuth + 360
+  Checked while parsing, before the sink and the event log are opened.
 
-  azimuth = azimuth % 360
+  @param      text  The command line value
 
-  # the layout for L and R are the same
-  actual_elevation = get_closest_key(
-  	hrtf['L'].keys(), 
-  	elevation
-  )
-  actual_azimuth = get_closest_key(
-  	hrtf['L'][actual_elevation].keys(), 
-  	azimuth
-  )
-
-  left = convolve(
-  	data, 
-  	hrtf['L'][actual_elevation][actual_azimuth]
-  )
-  right = convolve(
-  	data, 
-  	hrtf['L'][actual_elevation][0 if actual_azimuth is 0 else 360 - actual_azimuth]
-  )
-  stereo = np.transpose([left, right])
-  return stereo
-
-def add_circle_point(window, text, degrees, radius, attribute):
-  center_y = window.getmaxyx()[0]
-  center_x = window.getmaxyx()[1]
-  seg_length = radius
-  window.addstr(
-    center_y/2 - int(seg_length * math.cos(math.pi/180 * degrees)), 
-    center_x/2 - len(text)/2 + int(2 * seg_length * math.sin(math.pi/180 * degrees)), 
-    text,
-    attribute
-  )
-
-def main(stdscr):
-  hrtf = load_hrtf()
+  @return     { degrees the cursor moves by }
+  """
+  from circle import check_step
+
+  step = int(text)
+  try:
+    check_step(step)
+  except ValueError as error:
+    raise argparse.ArgumentTypeError(str(error))
+  return step
+
+def main(stdscr, bank=None, sink=None, resolution=RESOLUTION, events=None):
+  # only the experiment needs a terminal
+  import curses
+  import soundfile as sf
+  from session import Session
+
+  if sink is None:
+    sink = StreamSink()
+
+  hrtf = bank if bank is not None else open_bank(headphones=HEADPHONES)
+  # transform the filters now rather than during the first trial
+  warm_spectra(hrtf)
+  # sets 1-3 replay the same directions, so each one is rendered once
+  renders = RenderCache(hrtf)
   data, fs = sf.read("ping.wav")
+  # open the output stream once for the whole session
+  sink.open(fs)
 
   stdscr.clear()
   curses.curs_set(0)
   curses.cbreak()
-
-  trial_1_source = list()
-  trial_1_resp = list()
-  trial_2_source = list()
-  trial_2_resp = list()
-  trial_3_source = list()
-  trial_3_resp = list()
-
-  selected = 0
-
-  center_y = stdscr.getmaxyx()[0]
-  center_x = stdscr.getmaxyx()[1]
-
   curses.init_pair(1, curses.COLOR_RED, 0)
 
   directions = list()
@@ -190,738 +90,188 @@ def main(stdscr):
   for item in range(0, 10):
     directions.append(random.randrange(0, 360, 10))
 
-  #############################################################################
-  #
-  # Part 0 - Intro
-  #
-  #############################################################################
-
-  text = list()
-  text.append("Welcome to our EE322 final project!")
-  text.append("Move cursor with the arrow keys")
-  text.append("0 degrees is directly in front of you")
-  text.append("180 degrees is directly behind you")
-  text.append("Hover the cursor over the number and")
-  text.append("press 'Enter' to select")
-
-  for index, line in enumerate(text):
-    stdscr.addstr(
-      center_y/2 - int(math.ceil(len(text)/2)) + index,
-      center_x/2 - int(math.ceil(len(line)/2)),
-      line
-    )
-
-  ready = "Ready? "
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)), 
-    center_x/2 - int(math.ceil(len(ready)/2)),
-    ready 
-  )
-  enter = "[ENTER]"
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)), 
-    center_x/2 + int(math.ceil(len(ready)/2)),
-    enter,
-    curses.A_BLINK | curses.A_REVERSE
+  # the three sets play the same directions in the same order, the next
+  # trial renders while the listener is still answering this one
+  session = Session(
+    stdscr,
+    renders,
+    data[:, 0],
+    fs,
+    directions,
+    sink,
+    depth=PREFETCH_DEPTH,
+    step=resolution,
+    events=events
   )
+  results = session.run()
+  curses.endwin()
 
-  while True:
-    for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-    ch = stdscr.getch()
-    
-    if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-      enter_clear = "       "
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)), 
-        center_x/2 + int(math.ceil(len(ready)/2)),
-        enter_clear,
-        curses.A_NORMAL
-      )
-      break
-
-    elif ch == curses.KEY_RIGHT:
-      if selected == 90:
-        continue
-      elif selected > 270 or selected < 90:
-        selected += 10
-      else:
-        selected -= 10
-
-    elif ch == curses.KEY_LEFT:
-      if selected == 270:
-        continue
-      if selected > 270 or selected < 90:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_UP:
-      if selected == 0:
-        continue
-      if selected < 180:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_DOWN:
-      if selected == 180:
-        continue
-      if selected < 180:
-        selected += 10
-      else:
-        selected -= 10
-
-    if selected == 360:
-      selected = 0
-    elif selected == -10:
-      selected = 350
-
-  #############################################################################
-  #
-  # Part 1 - Ping from random locations, record results
-  #
-  #############################################################################
-  
-  stdscr.clear()
-
-  text = list()
-  text.append("Set 1: Best Guess")
-  text.append("Locate the direction of the ping as best you can")
-
-  for index, line in enumerate(text):
-    stdscr.addstr(
-      center_y/2 - int(math.ceil(len(text)/2)) + index,
-      center_x/2 - int(math.ceil(len(line)/2)),
-      line
-    )
-
-  ready = "Ready? "
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)), 
-    center_x/2 - int(math.ceil(len(ready)/2)),
-    ready 
-  )
-  enter = "[ENTER]"
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)), 
-    center_x/2 + int(math.ceil(len(ready)/2)),
-    enter,
-    curses.A_BLINK | curses.A_REVERSE
-  )
-
-  while True:
-    for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-    ch = stdscr.getch()
-    
-    if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-      enter_clear = "       "
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)), 
-        center_x/2 + int(math.ceil(len(ready)/2)),
-        enter_clear,
-        curses.A_NORMAL
-      )
-      break
-
-    elif ch == curses.KEY_RIGHT:
-      if selected == 90:
-        continue
-      elif selected > 270 or selected < 90:
-        selected += 10
-      else:
-        selected -= 10
-
-    elif ch == curses.KEY_LEFT:
-      if selected == 270:
-        continue
-      if selected > 270 or selected < 90:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_UP:
-      if selected == 0:
-        continue
-      if selected < 180:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_DOWN:
-      if selected == 180:
-        continue
-      if selected < 180:
-        selected += 10
-      else:
-        selected -= 10
-
-    if selected == 360:
-      selected = 0
-    elif selected == -10:
-      selected = 350
-
-  for trial in range(0, 10):
-    for index in range(5, -1, -1):
-      countdown = "Ping in {}".format(index)
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)), 
-        center_x/2 - int(math.ceil(len(countdown)/2)),
-        countdown
-      )
-      stdscr.refresh()
-      sleep(1)
-
-    stdscr.refresh()
-
-    trial_1_source.append(directions[trial])
-
-    stereo = convolve_stereo(data[:, 0], hrtf, 0, directions[trial])
-    sd.play(stereo, fs, blocking=False)
-    sd.wait()
-
-    while True:
-      for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-      ch = stdscr.getch()
-      
-      if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-        break
-
-      elif ch == curses.KEY_RIGHT:
-        if selected == 90:
-          continue
-        elif selected > 270 or selected < 90:
-          selected += 10
-        else:
-          selected -= 10
-
-      elif ch == curses.KEY_LEFT:
-        if selected == 270:
-          continue
-        if selected > 270 or selected < 90:
-          selected -= 10
-        else:
-          selected += 10
-
-      elif ch == curses.KEY_UP:
-        if selected == 0:
-          continue
-        if selected < 180:
-          selected -= 10
-        else:
-          selected += 10
-
-      elif ch == curses.KEY_DOWN:
-        if selected == 180:
-          continue
-        if selected < 180:
-          selected += 10
-        else:
-          selected -= 10
-
-      if selected == 360:
-        selected = 0
-      elif selected == -10:
-        selected = 350
-
-    trial_1_resp.append(selected)
-
-  #############################################################################
-  #
-  # Part 2 - Ping from random locations, notify the player, record results
-  #
-  #############################################################################
-
-  stdscr.clear()
-
-  text = list()
-  text.append("Set 2: Training")
-  text.append("A red asterisk (*) will be shown")
-  text.append("to indicate where the ping is coming from")
-  text.append("Important: The red asterisk may not represent")
-  text.append("exactly where you hear it from")
-  text.append("Locate the direction of the ping as best you can")
-
-  for index, line in enumerate(text):
-    stdscr.addstr(
-      center_y/2 - int(math.ceil(len(text)/2)) + index, 
-      center_x/2 - int(math.ceil(len(line)/2)), 
-      line
-    )
-
-  ready = "Ready? "
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)), 
-    center_x/2 - int(math.ceil(len(ready)/2)),
-    ready 
-  )
-  enter = "[ENTER]"
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)), 
-    center_x/2 + int(math.ceil(len(ready)/2)),
-    enter,
-    curses.A_BLINK | curses.A_REVERSE
-  )
-
-  while True:
-    for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-    ch = stdscr.getch()
-    
-    if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-      enter_clear = "       "
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)), 
-        center_x/2 + int(math.ceil(len(ready)/2)),
-        enter_clear,
-        curses.A_NORMAL
-      )
-      break
-
-    elif ch == curses.KEY_RIGHT:
-      if selected == 90:
-        continue
-      elif selected > 270 or selected < 90:
-        selected += 10
-      else:
-        selected -= 10
-
-    elif ch == curses.KEY_LEFT:
-      if selected == 270:
-        continue
-      if selected > 270 or selected < 90:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_UP:
-      if selected == 0:
-        continue
-      if selected < 180:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_DOWN:
-      if selected == 180:
-        continue
-      if selected < 180:
-        selected += 10
-      else:
-        selected -= 10
-
-    if selected == 360:
-      selected = 0
-    elif selected == -10:
-      selected = 350
-
-  for trial in range(0, 10):
-
-    trial_2_source.append(directions[trial])
-
-    add_circle_point(
-      stdscr, 
-      "*", 
-      directions[trial], 
-      min(center_y, center_x)/2 - 2, 
-      curses.color_pair(1)
-    )
-    stdscr.refresh()
-
-    for index in range(5, -1, -1):
-      countdown = "Ping in {}".format(index)
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)), 
-        center_x/2 - int(math.ceil(len(countdown)/2)), 
-        countdown
-      )
-      stdscr.refresh()
-      sleep(1)
-
-    stereo = convolve_stereo(data[:, 0], hrtf, 0, directions[trial])
-    sd.play(stereo, fs)
-    sd.wait()
-
-    while True:
-      for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-      ch = stdscr.getch()
-      
-      if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-        break
-
-      elif ch == curses.KEY_RIGHT:
-        if selected == 90:
-          continue
-        elif selected > 270 or selected < 90:
-          selected += 10
-        else:
-          selected -= 10
-
-      elif ch == curses.KEY_LEFT:
-        if selected == 270:
-          continue
-        if selected > 270 or selected < 90:
-          selected -= 10
-        else:
-          selected += 10
-
-      elif ch == curses.KEY_UP:
-        if selected == 0:
-          continue
-        if selected < 180:
-          selected -= 10
-        else:
-          selected += 10
-
-      elif ch == curses.KEY_DOWN:
-        if selected == 180:
-          continue
-        if selected < 180:
-          selected += 10
-        else:
-          selected -= 10
-
-      if selected == 360:
-        selected = 0
-      elif selected == -10:
-        selected = 350
-
-    trial_2_resp.append(selected)
-
-    add_circle_point(
-      stdscr, 
-      " ", 
-      directions[trial], 
-      min(center_y, center_x)/2 - 2,
-      curses.A_NORMAL
-    )
-    stdscr.refresh()
-
-  #############################################################################
-  #
-  # Part 3 - Ping from random locations, record results
-  #
-  #############################################################################
-  
-  stdscr.clear()
-
-  text = list()
-  text.append("Set 3: Training Results")
-  text.append("Now, there won't be any asterisk")
-  text.append("Locate the direction of the ping as best you can")
-
-  for index, line in enumerate(text):
-    stdscr.addstr(
-      center_y/2 - int(math.ceil(len(text)/2)) + index,
-      center_x/2 - int(math.ceil(len(line)/2)),
-      line
+  return results, session.stats()
+
+def experiment(args):
+  import curses
+  from time import time
+
+  from events import EventLog
+  from store import ResultsStore
+
+  # fail before the session rather than lose it at the end
+  bank = open_bank(args.root, args.headphones, args.minphase)
+  started = time()
+  sink = open_sink(args.sink)
+  events = None
+  if args.events:
+    events = EventLog(
+      args.events,
+      sink=args.sink,
+      headphones=args.headphones,
+      minphase=args.minphase,
+      resolution=args.resolution,
+      subject=args.subject
     )
-
-  ready = "Ready? "
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-    center_x/2 - int(math.ceil(len(ready)/2)),
-    ready 
-  )
-  enter = "[ENTER]"
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-    center_x/2 + int(math.ceil(len(ready)/2)),
-    enter,
-    curses.A_BLINK | curses.A_REVERSE
-  )
-
-  while True:
-    for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-    ch = stdscr.getch()
-    
-    if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-      enter_clear = "       "
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-        center_x/2 + int(math.ceil(len(ready)/2)),
-        enter_clear,
-        curses.A_NORMAL
-      )
-      break
-
-    elif ch == curses.KEY_RIGHT:
-      if selected == 90:
-        continue
-      elif selected > 270 or selected < 90:
-        selected += 10
-      else:
-        selected -= 10
-
-    elif ch == curses.KEY_LEFT:
-      if selected == 270:
-        continue
-      if selected > 270 or selected < 90:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_UP:
-      if selected == 0:
-        continue
-      if selected < 180:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_DOWN:
-      if selected == 180:
-        continue
-      if selected < 180:
-        selected += 10
-      else:
-        selected -= 10
-
-    if selected == 360:
-      selected = 0
-    elif selected == -10:
-      selected = 350
-
-  for trial in range(0, 10):
-    for index in range(5, -1, -1):
-      countdown = "Ping in {}".format(index)
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-        center_x/2 - int(math.ceil(len(countdown)/2)),
-        countdown
-      )
-      stdscr.refresh()
-      sleep(1)
-
-    stdscr.refresh()
-
-    trial_3_source.append(directions[trial])
-
-    stereo = convolve_stereo(data[:, 0], hrtf, 0, directions[trial])
-    sd.play(stereo, fs)
-    sd.wait()
-
-    while True:
-      for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-      ch = stdscr.getch()
-      
-      if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-        break
-
-      elif ch == curses.KEY_RIGHT:
-        if selected == 90:
-          continue
-        elif selected > 270 or selected < 90:
-          selected += 10
-        else:
-          selected -= 10
-
-      elif ch == curses.KEY_LEFT:
-        if selected == 270:
-          continue
-        if selected > 270 or selected < 90:
-          selected -= 10
-        else:
-          selected += 10
-
-      elif ch == curses.KEY_UP:
-        if selected == 0:
-          continue
-        if selected < 180:
-          selected -= 10
-        else:
-          selected += 10
-
-      elif ch == curses.KEY_DOWN:
-        if selected == 180:
-          continue
-        if selected < 180:
-          selected += 10
-        else:
-          selected -= 10
-
-      if selected == 360:
-        selected = 0
-      elif selected == -10:
-        selected = 350
-
-    trial_3_resp.append(selected)
-
-  #############################################################################
-  #
-  # Results
-  #
-  #############################################################################
-  
-  stdscr.clear()
-
-  set_1_avg = float()
-  set_2_avg = float()
-  set_3_avg = float()
-
-  for index in range(0, 10):
-    set_1_avg += (math.cos(math.pi / 180 * abs(trial_1_resp[index] - trial_1_source[index])) + 1)/2
-    set_2_avg += (math.cos(math.pi / 180 * abs(trial_2_resp[index] - trial_2_source[index])) + 1)/2
-    set_3_avg += (math.cos(math.pi / 180 * abs(trial_3_resp[index] - trial_3_source[index])) + 1)/2
-
-  set_1_avg *= 10
-  set_2_avg *= 10
-  set_3_avg *= 10
-
-  text = list()
-  text.append("Game Over!")
-  text.append("Set 1 results: {0:.2f}% Accuracy".format(set_1_avg))
-  text.append("Set 2 results: {0:.2f}% Accuracy".format(set_2_avg))
-  text.append("Set 3 results: {0:.2f}% Accuracy".format(set_3_avg))
-
-  for index, line in enumerate(text):
-    stdscr.addstr(
-      center_y/2 - int(math.ceil(len(text)/2)) + index,
-      center_x/2 - int(math.ceil(len(line)/2)),
-      line
+  store = ResultsStore(args.results)
+  try:
+    results, prefetch_stats = curses.wrapper(
+      main,
+      bank,
+      sink,
+      args.resolution,
+      events
     )
 
-  ready = "Finished? "
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-    center_x/2 - int(math.ceil(len(ready)/2)),
-    ready 
+    # an aborted session leaves no results behind
+    if results is not None:
+      print("session {} of {} stored in {}".format(
+        store.add_session(
+          args.subject,
+          results,
+          started,
+          "ping.wav",
+          headphones=args.headphones,
+          minphase=args.minphase,
+          sink=args.sink,
+          resolution=args.resolution
+        ),
+        args.subject,
+        args.results
+      ))
+  finally:
+    store.close()
+    sink.close()
+    if events is not None:
+      events.close()
+  print("playback waited on {waits} of {gets} renders ({wait_time:.3f} s)".format(
+    **prefetch_stats
+  ))
+  print("{buffers} buffers out, {late} late".format(**sink.stats()))
+
+def render(args):
+  import soundfile as sf
+
+  data, fs = sf.read(getattr(args, "in"))
+  if data.ndim > 1:
+    data = data[:, 0]
+  bank = open_bank(args.root, args.headphones, args.minphase)
+
+  stereo = convolve_stereo(
+    data,
+    bank,
+    args.elev,
+    args.az,
+    interpolate=args.interpolate,
+    fs=fs
   )
-  enter = "[ENTER]"
-  stdscr.addstr(
-    center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-    center_x/2 + int(math.ceil(len(ready)/2)),
-    enter,
-    curses.A_BLINK | curses.A_REVERSE
+  sf.write(args.out, stereo, fs, subtype="FLOAT")
+  print("{} -> {} ({:+g} elevation, {:g} azimuth, peak {:.3f})".format(
+    getattr(args, "in"),
+    args.out,
+    args.elev,
+    args.az,
+    np.abs(stereo).max()
+  ))
+
+def bench(args):
+  import bench
+
+  return bench.main(
+    args,
+    lambda: open_bank(args.root, args.headphones, args.minphase)
   )
 
-  while True:
-    for deg in range(0, 360, 10):
-        add_circle_point(
-          stdscr, 
-          str(deg), 
-          deg,
-          min(center_y, center_x)/2,
-          curses.A_REVERSE if deg == selected else curses.A_NORMAL
-        )
-
-    ch = stdscr.getch()
-    
-    if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-      enter_clear = "       "
-      stdscr.addstr(
-        center_y/2 + int(math.ceil(len(text)/2)) + 1, 
-        center_x/2 + int(math.ceil(len(ready)/2)),
-        enter_clear,
-        curses.A_NORMAL
-      )
-      break
-
-    elif ch == curses.KEY_RIGHT:
-      if selected == 90:
-        continue
-      elif selected > 270 or selected < 90:
-        selected += 10
-      else:
-        selected -= 10
-
-    elif ch == curses.KEY_LEFT:
-      if selected == 270:
-        continue
-      if selected > 270 or selected < 90:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_UP:
-      if selected == 0:
-        continue
-      if selected < 180:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_DOWN:
-      if selected == 180:
-        continue
-      if selected < 180:
-        selected += 10
-      else:
-        selected -= 10
-
-    if selected == 360:
-      selected = 0
-    elif selected == -10:
-      selected = 350
-
-  f = open("res.csv", "w")
-  for index in range(0, 10):
-    f.write("{},{},{},{},{},{}\n".format(
-      trial_1_resp[index], 
-      trial_1_source[index], 
-      trial_2_resp[index], 
-      trial_2_source[index], 
-      trial_3_resp[index], 
-      trial_3_source[index]
-    ))
-  f.close()
-  curses.endwin()
-
-curses.wrapper(main)
-
-# if __name__ == '__main__':
-#   main()
+if __name__ == '__main__':
+  # python main.py [experiment | render | bench], the experiment by default
+  import getpass
+  import sys
+  from bench import add_arguments as bench_arguments
+  from store import RESULTS_DB
+  import instrument
+
+  parser = argparse.ArgumentParser(description="EE322 HRTF experiment")
+  parser.add_argument("--root", default=HRTF_ROOT, help="dataset directory")
+  parser.add_argument("--headphones", default=HEADPHONES,
+                      help="headphone model to compensate for")
+  parser.add_argument("--minphase", type=int, default=None,
+                      help="render with minimum phase filters of this length")
+  parser.add_argument("--instrument", default=None,
+                      help="time the hot paths and write a summary to this "
+                           "file at exit and on SIGUSR1, - for stderr")
+  parser.add_argument("--memory", action="store_true",
+                      help="with --instrument, trace peak memory too")
+  parser.add_argument("--profile", default=None,
+                      help="write cProfile stats of the run to this file")
+  # the experiment options, declared once for the subcommand and for
+  # running without one
+  experiment_options = argparse.ArgumentParser(add_help=False)
+  experiment_options.add_argument("--sink", default="stream",
+                                  help="stream[:NAME], device[:NAME], "
+                                       "file:DIRECTORY, null or null:fast")
+  experiment_options.add_argument("--resolution", type=resolution,
+                                  default=RESOLUTION,
+                                  help="degrees the cursor moves by, e.g. 5 "
+                                       "or 1")
+  experiment_options.add_argument("--events", default=EVENT_LOG,
+                                  help="append trial events to this file, "
+                                       "'' for none")
+  experiment_options.add_argument("--subject", default=getpass.getuser(),
+                                  help="who is taking part, the login name "
+                                       "by default")
+  experiment_options.add_argument("--results", default=RESULTS_DB,
+                                  help="results store the session is "
+                                       "appended to")
+  parser.set_defaults(**vars(experiment_options.parse_args([])))
+  commands = parser.add_subparsers(dest="command")
+
+  commands.add_parser("experiment", parents=[experiment_options],
+                      help="run the listening experiment")
+
+  command = commands.add_parser("render", help="render a source to a file")
+  command.add_argument("--in", required=True, help="source wav file")
+  command.add_argument("--az", type=float, required=True, help="azimuth")
+  command.add_argument("--elev", type=float, default=0, help="elevation")
+  command.add_argument("--out", required=True, help="stereo wav file")
+  command.add_argument("--interpolate", action="store_true",
+                       help="blend the surrounding measured directions")
+
+  command = commands.add_parser("bench", help="time the hot paths")
+  bench_arguments(command)
+
+  args = parser.parse_args()
+  run = {
+    None: experiment,
+    "experiment": experiment,
+    "render": render,
+    "bench": bench
+  }[args.command]
+
+  if args.instrument is not None:
+    instrument.enable(args.memory)
+    instrument.dump_on_signal(args.instrument)
+  try:
+    if args.profile is not None:
+      status = instrument.profiled(run, args.profile, args)
+    else:
+      status = run(args)
+  finally:
+    if args.instrument is not None:
+      instrument.dump(args.instrument)
+  sys.exit(status)
@@ -0,0 +1,195 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Mixing several spatialized sources into one binaural signal
+#
+###############################################################################
+
+from time import perf_counter
+import numpy as np
+
+from render import FFT_SIZE, fit_fft_size, overlap_add, source_spectrum
+from stream import BLOCKSIZE, StreamRenderer
+
+def source_pairs(bank, sources):
+  """
+  @brief      { Resolves the direction of every source to a bank row }
+
+  @param      bank     The HRTFBank
+  @param      sources  sequence of (data, elevation, azimuth, gain)
+
+  @return     { (rows shaped (K,), gains shaped (K,)) }
+  """
+  elevations = np.array([source[1] for source in sources], dtype=np.float64)
+  azimuths = np.array([source[2] for source in sources], dtype=np.float64)
+  gains = np.array([source[3] for source in sources], dtype=np.float64)
+
+  return bank.lookup(elevations, azimuths), gains
+
+def mix(sources, bank, fft_size=FFT_SIZE, fs=None):
+  """
+  @brief      { Renders K sources, each from its own direction, into one pair }
+
+  Every source is transformed once, weighted by its gain and filter
+  spectra, and summed per ear in the frequency domain, so the whole mix
+  costs two inverse transforms whatever K is.
+
+  @param      sources   sequence of (data, elevation, azimuth, gain)
+  @param      bank      The HRTFBank
+  @param      fft_size  The transform length
+  @param      fs        The sample rate of the sources, None for the bank's
+
+  @return     { stereo matrix shaped (longest source + taps - 1, 2) }
+  """
+  bank = bank.at_rate(fs).delayed()
+  fft_size = fit_fft_size(fft_size, bank.taps)
+  rows, gains = source_pairs(bank, sources)
+  length = max(len(source[0]) for source in sources)
+
+  spectra = bank.spectra(fft_size)[bank.ears(rows)]
+  mixed = None
+  for (data, _, _, _), pair, gain in zip(sources, spectra, gains):
+    padded = np.zeros(length)
+    padded[:len(data)] = data
+    source = source_spectrum(padded, fft_size, bank.taps)
+    ears = gain * pair[:, np.newaxis] * source[np.newaxis]
+    if mixed is None:
+      mixed = ears
+    else:
+      mixed += ears
+
+  return np.transpose(overlap_add(mixed, fft_size, bank.taps, length))
+
+class MixConvolver(object):
+  """
+  @brief      { Block by block mix of K sources (uniform partitions) }
+
+  Same overlap-save scheme as stream.PartitionedConvolver with one delay
+  line per source. The products of all sources and partitions are summed
+  per ear before the two inverse transforms.
+  """
+
+  def __init__(self, partitions, gains, block):
+    """
+    @param      partitions  complex array shaped (K, 2, partition, block + 1)
+    @param      gains       gain of every source
+    @param      block       The block length
+    """
+    self.block = block
+    self.partitions = partitions * np.asarray(gains)[:, None, None, None]
+    self.history = np.zeros(
+      (partitions.shape[0], partitions.shape[2], block + 1),
+      dtype=np.complex128
+    )
+    self.window = np.zeros((partitions.shape[0], 2 * block))
+
+  def process(self, blocks):
+    """
+    @brief      { Mixes the next block of every source }
+
+    @param      blocks  input shaped (K, self.block)
+
+    @return     { stereo output shaped (self.block, 2) }
+    """
+    self.window[:, :self.block] = self.window[:, self.block:]
+    self.window[:, self.block:] = blocks
+
+    self.history = np.roll(self.history, 1, axis=1)
+    self.history[:, 0] = np.fft.rfft(self.window, axis=-1)
+
+    spectrum = np.einsum("kepf,kpf->ef", self.partitions, self.history)
+    return np.fft.irfft(spectrum, n=2 * self.block, axis=-1)[:, self.block:].T
+
+class StreamMixer(StreamRenderer):
+  """
+  @brief      { Feeds a sounddevice output callback with a K source mix }
+
+  The sources are stacked in one (K, length) matrix and looked up together,
+  the rest is StreamRenderer with a MixConvolver.
+  """
+
+  def __init__(self, sources, bank, blocksize=BLOCKSIZE, fs=None):
+    length = max(len(source[0]) for source in sources)
+    data = np.zeros((len(sources), length))
+    for index, source in enumerate(sources):
+      data[index, :len(source[0])] = source[0]
+
+    self.gains = np.array([source[3] for source in sources], dtype=np.float64)
+    super(StreamMixer, self).__init__(
+      data,
+      bank,
+      np.array([source[1] for source in sources], dtype=np.float64),
+      np.array([source[2] for source in sources], dtype=np.float64),
+      blocksize,
+      fs
+    )
+
+  def make_convolver(self, partitions, blocksize):
+    return MixConvolver(partitions, self.gains, blocksize)
+
+  def process(self, outdata):
+    """
+    @brief      { Mixes the next block straight into outdata }
+
+    @param      outdata  array shaped (blocksize, 2)
+    """
+    blocks = self.data[:, self.position:self.position + self.blocksize]
+    if blocks.shape[1] < self.blocksize:
+      blocks = np.pad(blocks, ((0, 0), (0, self.blocksize - blocks.shape[1])),
+                      mode="constant")
+
+    outdata[:] = self.convolver.process(blocks)
+
+    remaining = self.length - self.position
+    if remaining < self.blocksize:
+      outdata[remaining:] = 0
+    self.position += self.blocksize
+
+if __name__ == '__main__':
+  # python mixer.py: sweep the number of sources
+  import soundfile as sf
+  from hrtf import HRTFBank
+  from render import convolve_stereo
+
+  data, fs = sf.read("ping.wav")
+  data = data[:, 0]
+  bank = HRTFBank.open()
+  bank.spectra(FFT_SIZE)
+  bank.partitions(BLOCKSIZE)
+
+  print("   K  separate ms  mixed ms  block us (budget {:.0f} us)".format(
+    BLOCKSIZE * 1e6 / fs
+  ))
+  for count in (1, 2, 4, 8, 16, 32, 64):
+    sources = [
+      (np.roll(data, 997 * k), 0, (37 * k) % 360, 1.0 / count)
+      for k in range(count)
+    ]
+
+    start = perf_counter()
+    separate = sum(
+      gain * convolve_stereo(signal, bank, elevation, azimuth)
+      for signal, elevation, azimuth, gain in sources
+    )
+    separate_time = perf_counter() - start
+
+    start = perf_counter()
+    mixed = mix(sources, bank)
+    mixed_time = perf_counter() - start
+
+    streamer = StreamMixer(sources, bank)
+    outdata = np.empty((BLOCKSIZE, 2))
+    blocks = 0
+    start = perf_counter()
+    while not streamer.done():
+      streamer.process(outdata)
+      blocks += 1
+    block_time = (perf_counter() - start) / blocks
+
+    print("{:4d}  {:11.1f}  {:8.1f}  {:8.1f}".format(
+      count,
+      separate_time * 1e3,
+      mixed_time * 1e3,
+      block_time * 1e6
+    ))
@@ -0,0 +1,277 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Offline rendering of stimuli from every measured direction
+#
+###############################################################################
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+import argparse
+import hashlib
+import json
+import os
+import signal
+import sys
+import numpy as np
+import soundfile as sf
+
+from hrtf import HRTF_ROOT, HRTFBank
+from render import render_batch, signal_digest
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# directions rendered per task, small enough to keep every worker busy
+TASK_SIZE = 16
+
+# state of each worker process, set up once by init_worker
+_worker = dict()
+
+class Interrupted(KeyboardInterrupt):
+  """
+  @brief      { Ctrl-C stopped render_all, what was written is recorded }
+  """
+
+  def __init__(self, written, total):
+    super(Interrupted, self).__init__(written, total)
+    self.written = written
+    self.total = total
+
+def read_source(path):
+  """
+  @brief      { Reads a stimulus as a mono signal }
+
+  @param      path  The wav file
+
+  @return     { (data, fs) }
+  """
+  data, fs = sf.read(path)
+  if data.ndim > 1:
+    data = data[:, 0]
+  return data, fs
+
+def output_path(source, elevation, azimuth):
+  """
+  @brief      { Where the render of a source from a direction goes }
+
+  @param      source     The source wav file
+  @param      elevation  The measured elevation
+  @param      azimuth    The measured azimuth
+
+  @return     { path of the wav file within the output directory }
+  """
+  # sources of the same name in different directories must not overwrite
+  # each other, so the directory is keyed on the full path too
+  stem = os.path.splitext(os.path.basename(source))[0]
+  key = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()
+  return os.path.join(
+    "{}-{}".format(stem, key[:8]),
+    "elev{:d}".format(elevation),
+    "{:s}{:d}e{:03d}a.wav".format(stem, elevation, azimuth)
+  )
+
+def read_manifest(out):
+  """
+  @brief      { Lists the renders already finished in an output directory }
+
+  @param      out   The output directory
+
+  @return     { dict of output_path() -> sha1 of the source it was
+                  rendered from, for the renders that still exist }
+  """
+  done = dict()
+  try:
+    with open(os.path.join(out, MANIFEST_NAME), "r") as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # the last line may be cut short by an interrupt
+          continue
+        if os.path.exists(os.path.join(out, record["path"])):
+          done[record["path"]] = record["sha1"]
+  except (IOError, OSError):
+    pass
+  return done
+
+def init_worker(root):
+  # Ctrl-C is handled by the parent, which lets running tasks finish
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  # every worker maps the same compiled bank, the pages are shared
+  _worker["bank"] = HRTFBank.open(root)
+  _worker["sources"] = dict()
+
+def render_task(source, rows, out):
+  """
+  @brief      { Renders one source from a handful of bank rows }
+
+  @param      source  The source wav file
+  @param      rows    rows of the bank to render
+  @param      out     The output directory
+
+  @return     { list of manifest records }
+  """
+  bank = _worker["bank"]
+  if source not in _worker["sources"]:
+    data, fs = read_source(source)
+    _worker["sources"][source] = (data, fs, signal_digest(data))
+  data, fs, digest = _worker["sources"][source]
+
+  elevations = bank.elevations[rows]
+  azimuths = bank.azimuths[rows]
+  stereo = render_batch(
+    data,
+    bank,
+    np.stack([elevations, azimuths], axis=1),
+    fs=fs
+  )
+
+  records = list()
+  for index, (elevation, azimuth) in enumerate(zip(elevations, azimuths)):
+    path = os.path.join(
+      out,
+      output_path(source, int(elevation), int(azimuth))
+    )
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError:
+        # another worker created it first
+        pass
+
+    # rename into place so that an interrupted write is never counted
+    temporary = path + ".{}.tmp".format(os.getpid())
+    sf.write(temporary, stereo[index], fs, subtype="FLOAT", format="WAV")
+    os.replace(temporary, path)
+
+    records.append({
+      "source": source,
+      "sha1": digest,
+      "elevation": int(elevation),
+      "azimuth": int(azimuth),
+      "fs": fs,
+      "peak": float(np.max(np.abs(stereo[index]))),
+      "path": os.path.relpath(path, out)
+    })
+  return records
+
+def render_all(sources, out, root=HRTF_ROOT, workers=None,
+               task_size=TASK_SIZE, progress=sys.stderr):
+  """
+  @brief      { Renders every source from every measured direction }
+
+  Work is spread over a process pool. Finished renders are appended to the
+  manifest as they come in, so an interrupted run resumes where it stopped.
+  A render is done again when its source has changed since.
+
+  @param      sources    list of source wav files
+  @param      out        The output directory
+  @param      root       The dataset directory
+  @param      workers    Number of processes, defaults to the core count
+  @param      task_size  directions per task
+  @param      progress   stream for progress lines, None for quiet
+
+  @return     { number of renders written, raises Interrupted on Ctrl-C }
+  """
+  bank = HRTFBank.open(root)
+  done = read_manifest(out)
+
+  tasks = list()
+  for source in sources:
+    digest = signal_digest(read_source(source)[0])
+    pending = [
+      row for row in range(len(bank))
+      if done.get(output_path(
+        source,
+        int(bank.elevations[row]),
+        int(bank.azimuths[row])
+      )) != digest
+    ]
+    for start in range(0, len(pending), task_size):
+      tasks.append((source, pending[start:start + task_size]))
+
+  total = sum(len(rows) for _, rows in tasks)
+  if progress is not None:
+    progress.write("{} renders to do, {} already done\n".format(
+      total,
+      len(sources) * len(bank) - total
+    ))
+  if not total:
+    return 0
+
+  if not os.path.isdir(out):
+    os.makedirs(out)
+
+  written = 0
+  recorded = set()
+  start = time()
+  with open(os.path.join(out, MANIFEST_NAME), "a") as manifest, \
+      ProcessPoolExecutor(workers, initializer=init_worker,
+                          initargs=(root,)) as pool:
+    futures = [
+      pool.submit(render_task, source, rows, out) for source, rows in tasks
+    ]
+    try:
+      for future in as_completed(futures):
+        written += record(manifest, future)
+        recorded.add(future)
+        if progress is not None:
+          elapsed = time() - start
+          progress.write("\r{}/{} renders, {:.1f} per second".format(
+            written,
+            total,
+            written / elapsed if elapsed else 0.0
+          ))
+          progress.flush()
+    except KeyboardInterrupt:
+      # drop the tasks not started yet and record the ones still running
+      # before the pool shuts down, so that they are not done again
+      for future in futures:
+        future.cancel()
+      pending = [
+        future for future in futures
+        if not future.cancelled() and future not in recorded
+      ]
+      for future in as_completed(pending):
+        written += record(manifest, future)
+      raise Interrupted(written, total)
+
+  if progress is not None:
+    progress.write("\n")
+  return written
+
+def record(manifest, future):
+  """
+  @brief      { Appends the records of a finished task to the manifest }
+
+  @return     { number of renders the task wrote }
+  """
+  records = future.result()
+  for line in records:
+    manifest.write(json.dumps(line) + "\n")
+  manifest.flush()
+  return len(records)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    description="Render stimuli from every measured KEMAR direction"
+  )
+  parser.add_argument("sources", nargs="+", help="source wav files")
+  parser.add_argument("--out", default="renders", help="output directory")
+  parser.add_argument("--root", default=HRTF_ROOT, help="dataset directory")
+  parser.add_argument("--workers", type=int, default=None,
+                      help="worker processes, defaults to the core count")
+  args = parser.parse_args()
+
+  try:
+    render_all(args.sources, args.out, args.root, args.workers)
+  except Interrupted as interrupted:
+    sys.stderr.write(
+      "\ninterrupted, {} of {} renders done, {} left to resume\n".format(
+        interrupted.written,
+        interrupted.total,
+        interrupted.total - interrupted.written
+      )
+    )
+    sys.exit(130)
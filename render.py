@@ -0,0 +1,495 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Binaural rendering in the frequency domain
+#
+###############################################################################
+
+from collections import OrderedDict
+from time import time
+import hashlib
+import threading
+import numpy as np
+from hrtf import DELAY_TAPS, split_delays
+import instrument
+
+# 2048 point transforms cut the source into blocks of 1537 samples for the
+# 512 tap KEMAR filters, which keeps the spectra at about 11 MB per bank.
+# Shorter filters get shorter transforms, see fft_size_for()
+FFT_SIZE = 2048
+
+def block_length(fft_size, taps):
+  """
+  @brief      { Number of new source samples per overlap-add block }
+
+  @param      fft_size  The transform length
+  @param      taps      The filter length
+
+  @return     { block length }
+  """
+  block = fft_size - taps + 1
+  if block < taps - 1:
+    raise ValueError("fft size {} is too short for {} taps".format(
+      fft_size,
+      taps
+    ))
+  return block
+
+def fft_size_for(taps):
+  """
+  @brief      { The transform length renders use by default }
+
+  About eight times the filter length, up to FFT_SIZE. Truncated minimum
+  phase filters (64 taps, 88 with their fractional delay) get 1024 point
+  transforms, which render about a quarter faster than 2048 points.
+
+  @param      taps  The filter length
+
+  @return     { fft size }
+  """
+  return fit_fft_size(min(FFT_SIZE, 8 << int(np.ceil(np.log2(taps)))), taps)
+
+def fit_fft_size(fft_size, taps):
+  """
+  @brief      { Doubles the fft size until blocks fit the filter length }
+
+  @param      fft_size  The requested transform length
+  @param      taps      The filter length
+
+  @return     { fft size usable with block_length() }
+  """
+  while fft_size - taps + 1 < taps - 1:
+    fft_size *= 2
+  return fft_size
+
+def source_spectrum(data, fft_size, taps):
+  """
+  @brief      { Cuts the source into blocks and transforms all of them }
+
+  @param      data      mono source signal
+  @param      fft_size  The transform length
+  @param      taps      The filter length
+
+  @return     { complex array shaped (blocks, fft_size // 2 + 1) }
+  """
+  block = block_length(fft_size, taps)
+  n_blocks = max(1, -(-len(data) // block))
+
+  flat = np.zeros(n_blocks * block)
+  flat[:len(data)] = data
+
+  blocks = np.zeros((n_blocks, fft_size))
+  blocks[:, :block] = flat.reshape(n_blocks, block)
+  return np.fft.rfft(blocks, axis=-1)
+
+def overlap_add(spectrum, fft_size, taps, length):
+  """
+  @brief      { Inverse transforms the blocks and stitches them together }
+
+  @param      spectrum  complex array shaped (..., blocks, bins)
+  @param      fft_size  The transform length
+  @param      taps      The filter length
+  @param      length    Length of the source signal
+
+  @return     { array shaped (..., length + taps - 1) }
+  """
+  block = block_length(fft_size, taps)
+  frames = np.fft.irfft(spectrum, n=fft_size, axis=-1)
+  leading = frames.shape[:-2]
+  n_blocks = frames.shape[-2]
+
+  out = np.zeros(leading + ((n_blocks + 1) * block,), dtype=frames.dtype)
+  out[..., :n_blocks * block] = frames[..., :block].reshape(
+    leading + (n_blocks * block,)
+  )
+
+  # every block rings into the start of the next one
+  tails = out[..., block:].reshape(leading + (n_blocks, block))
+  tails[..., :taps - 1] += frames[..., block:]
+
+  return out[..., :length + taps - 1]
+
+def render_spectra(data, ears, fft_size, taps):
+  """
+  @brief      { Convolves the source with filters given as spectra }
+
+  The source is transformed once and the spectrum is shared by all filters.
+
+  @param      data      mono source signal
+  @param      ears      filter spectra shaped (ear, fft_size // 2 + 1)
+  @param      fft_size  The transform length
+  @param      taps      The filter length
+
+  @return     { matrix shaped (samples, ear) }
+  """
+  source = source_spectrum(data, fft_size, taps)
+  output = overlap_add(
+    source[np.newaxis] * ears[:, np.newaxis],
+    fft_size,
+    taps,
+    len(data)
+  )
+  return np.transpose(output)
+
+def shift_signals(signals, shifts, length):
+  """
+  @brief      { Delays every signal by a whole number of samples }
+
+  @param      signals  array shaped (..., samples)
+  @param      shifts   int array shaped (...)
+  @param      length   The length of the result
+
+  @return     { array shaped (..., length) }
+  """
+  samples = signals.shape[-1]
+  out = np.zeros(signals.shape[:-1] + (length,), dtype=signals.dtype)
+  for signal, shifted, shift in zip(
+    signals.reshape(-1, samples),
+    out.reshape(-1, length),
+    np.ravel(shifts)
+  ):
+    end = min(length, shift + samples)
+    shifted[shift:end] = signal[:end - shift]
+  return out
+
+def render_split(data, filters, delays, fft_size, room):
+  """
+  @brief      { Convolves the source with minimum phase filters and delays }
+
+  @param      data      mono source signal
+  @param      filters   minimum phase filters shaped (ear, taps)
+  @param      delays    delay of each ear in samples
+  @param      fft_size  The transform length, None for fft_size_for()
+  @param      room      samples the delays add, bank.delay_room
+
+  @return     { matrix shaped (samples, ear) }
+  """
+  folded, shifts = split_delays(filters, delays)
+  fft_size = fit_fft_size(
+    fft_size or fft_size_for(folded.shape[-1]),
+    folded.shape[-1]
+  )
+  output = render_spectra(
+    data,
+    np.fft.rfft(folded, n=fft_size, axis=-1),
+    fft_size,
+    folded.shape[-1]
+  )
+  return np.transpose(shift_signals(
+    np.transpose(output),
+    shifts,
+    len(data) + filters.shape[-1] - 1 + room
+  ))
+
+@instrument.timed("render.render_rows")
+def render_rows(data, bank, left_rows, right_rows, fft_size=None):
+  """
+  @brief      { Convolves the source with the given bank rows, one per ear }
+
+  @param      data        mono source signal
+  @param      bank        The HRTFBank
+  @param      left_rows   row of the left ear filter in bank.filters[0]
+  @param      right_rows  row of the right ear filter, on bank.right_side
+  @param      fft_size    The transform length, None for fft_size_for()
+
+  @return     { stereo matrix ready to be played }
+  """
+  index = ([0, bank.right_side], [left_rows, right_rows])
+  folded, shifts = bank.split() if bank.delays is not None else (bank, None)
+  fft_size = fit_fft_size(fft_size or fft_size_for(folded.taps), folded.taps)
+  ears = folded.spectra(fft_size)[index]
+  output = render_spectra(data, ears, fft_size, folded.taps)
+  if shifts is None:
+    return output
+  return np.transpose(shift_signals(
+    np.transpose(output),
+    shifts[index],
+    len(data) + bank.taps - 1 + bank.delay_room
+  ))
+
+def warm_spectra(bank, fft_size=None):
+  """
+  @brief      { Transforms the filters the renders of a bank will use }
+
+  Call it once up front rather than paying for it in the first render.
+
+  @param      bank      The HRTFBank
+  @param      fft_size  The transform length, None for fft_size_for()
+  """
+  if bank.delays is not None:
+    bank, _ = bank.split()
+  bank.spectra(fit_fft_size(fft_size or fft_size_for(bank.taps), bank.taps))
+
+def interpolated_filters(bank, elevation, azimuth, align=True):
+  """
+  @brief      { The blended filter pair for any direction }
+
+  The right ear is the left ear filter of the mirrored direction, like the
+  measured path uses bank.mirror.
+
+  @param      bank       The HRTFBank
+  @param      elevation  The requested elevation
+  @param      azimuth    The requested azimuth
+  @param      align      Time align the filters before blending
+
+  @return     { (filters shaped (2, taps), delays or None) }
+  """
+  arguments = (
+    [elevation, elevation],
+    [azimuth, -azimuth],
+    np.array([[0], [bank.right_side]])
+  )
+  filters = bank.interpolate(*arguments, align=align)
+  if bank.delays is None:
+    return filters, None
+  return filters, bank.delay(*arguments)
+
+@instrument.timed("render.convolve_stereo")
+def convolve_stereo(data, bank, elevation, azimuth, fft_size=None,
+                    interpolate=False, fs=None):
+  """
+  @brief      { performs the Fast Fourier Transform on the given array }
+
+  @param      data         The data
+  @param      bank         The HRTFBank
+  @param      elevation    The requested elevation
+  @param      azimuth      The requested azimuth
+  @param      fft_size     The transform length, None for fft_size_for()
+  @param      interpolate  Blend the surrounding filters instead of snapping
+                           to the closest measured direction
+  @param      fs           The sample rate of the data, None for the bank's
+
+  @return     { stereo matrix ready to be played }
+  """
+  bank = bank.at_rate(fs)
+
+  if interpolate:
+    filters, delays = interpolated_filters(bank, elevation, azimuth)
+    if delays is not None:
+      return render_split(data, filters, delays, fft_size, bank.delay_room)
+    fft_size = fit_fft_size(fft_size or fft_size_for(bank.taps), bank.taps)
+    ears = np.fft.rfft(filters, n=fft_size, axis=-1)
+    return render_spectra(data, ears, fft_size, bank.taps)
+
+  # lookup() clamps the elevation and wraps the azimuth
+  row = bank.lookup(elevation, azimuth)
+  return render_rows(data, bank, row, bank.mirror[row], fft_size)
+
+@instrument.timed("render.render_batch")
+def render_batch(data, bank, directions, out=None, fft_size=None,
+                 interpolate=False, chunk=4, dtype=np.float32, fs=None):
+  """
+  @brief      { Renders one source from many directions in one call }
+
+  The filter pairs of all directions are gathered from the bank at once,
+  the source is transformed once and every ear of every direction is a
+  single broadcast multiply. Directions are processed chunk at a time to
+  keep the spectra of the products bounded. The products are single
+  precision, which halves the memory traffic of the inverse transforms.
+
+  @param      data         mono source signal
+  @param      bank         The HRTFBank
+  @param      directions   sequence of (elevation, azimuth) pairs
+  @param      out          optional array shaped (n, samples, 2) to fill
+  @param      fft_size     The transform length, None for fft_size_for()
+  @param      interpolate  Blend the surrounding filters instead of snapping
+  @param      chunk        directions per broadcast multiply
+  @param      dtype        dtype of the output when out is not given
+  @param      fs           The sample rate of the data, None for the bank's
+
+  @return     { array shaped (n_directions, len(data) + taps - 1 + room, 2),
+                  room being bank.delay_room }
+  """
+  bank = bank.at_rate(fs)
+  # minimum phase filters grow by the fraction of their delay
+  taps = bank.taps if bank.delays is None else bank.taps + DELAY_TAPS
+  fft_size = fit_fft_size(fft_size or fft_size_for(taps), taps)
+  directions = np.asarray(directions, dtype=np.float64).reshape(-1, 2)
+  elevations, azimuths = directions[:, 0], directions[:, 1]
+  length = len(data) + bank.taps - 1 + bank.delay_room
+
+  if out is None:
+    out = np.empty((len(directions), length, 2), dtype=dtype)
+  elif out.shape != (len(directions), length, 2):
+    raise ValueError("out has shape {}, expected {}".format(
+      out.shape,
+      (len(directions), length, 2)
+    ))
+
+  shifts = None
+  if interpolate:
+    arguments = (
+      np.concatenate([elevations, elevations]),
+      np.concatenate([azimuths, -azimuths]),
+      np.repeat([0, bank.right_side], len(directions))[:, np.newaxis]
+    )
+    filters = bank.interpolate(*arguments)
+    filters = np.stack(np.split(filters, 2), axis=1)
+    if bank.delays is not None:
+      delays = np.stack(np.split(bank.delay(*arguments), 2), axis=1)
+      filters, shifts = split_delays(filters, delays)
+    ears = np.fft.rfft(filters, n=fft_size, axis=-1).astype(np.complex64)
+  else:
+    index = bank.ears(bank.lookup(elevations, azimuths))
+    if bank.delays is None:
+      ears = bank.spectra(fft_size)[index]
+    else:
+      folded, shifts = bank.split()
+      ears = folded.spectra(fft_size)[index]
+      shifts = shifts[index]
+
+  source = source_spectrum(data, fft_size, taps).astype(np.complex64)
+  for start in range(0, len(directions), chunk):
+    products = (
+      source[np.newaxis, np.newaxis] *
+      ears[start:start + chunk, :, np.newaxis]
+    )
+    rendered = overlap_add(products, fft_size, taps, len(data))
+    if shifts is not None:
+      rendered = shift_signals(rendered, shifts[start:start + chunk], length)
+    out[start:start + chunk] = np.swapaxes(rendered, 1, 2)
+  return out
+
+def convolve_stereo_direct(data, bank, elevation, azimuth):
+  """
+  @brief      { time domain reference for convolve_stereo }
+
+  @param      data       The data
+  @param      bank       The HRTFBank
+  @param      elevation  The requested elevation
+  @param      azimuth    The requested azimuth
+
+  @return     { stereo matrix ready to be played }
+  """
+  bank = bank.delayed()
+  row = bank.lookup(elevation, azimuth)
+  left = np.convolve(data, bank.filters[0, row])
+  right = np.convolve(data, bank.filters[bank.right_side, bank.mirror[row]])
+  return np.transpose([left, right])
+
+def signal_digest(data):
+  """
+  @brief      { Hashes the samples of a source signal }
+
+  @param      data  The source signal
+
+  @return     { hex digest, equal for equal samples }
+  """
+  data = np.ascontiguousarray(data)
+  digest = hashlib.sha1(data.view(np.uint8))
+  digest.update(str((data.dtype.str, data.shape)).encode())
+  return digest.hexdigest()
+
+class RenderCache(object):
+  """
+  @brief      { Memoizes convolve_stereo results under a byte budget }
+
+  Entries are keyed on (source digest, bank row, sample rate), the row
+  being the quantized direction the bank resolves the request to. The
+  least recently used renders are evicted once the budget is exceeded.
+  Cached buffers are read only, since they are handed out again. The cache
+  may be shared with the render thread of a session.
+  """
+
+  def __init__(self, bank, budget=64 * 1024 * 1024, fft_size=None):
+    self.bank = bank
+    self.budget = budget
+    self.fft_size = fft_size
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+
+  def key(self, data, elevation, azimuth, fs=None):
+    return (signal_digest(data), int(self.bank.lookup(elevation, azimuth)), fs)
+
+  def render(self, data, elevation, azimuth, fs=None):
+    """
+    @brief      { convolve_stereo, skipped if the same render is cached }
+
+    @param      data       The data
+    @param      elevation  The requested elevation
+    @param      azimuth    The requested azimuth
+    @param      fs         The sample rate of the data
+
+    @return     { read only stereo matrix ready to be played }
+    """
+    key = self.key(data, elevation, azimuth, fs)
+    with self.lock:
+      stereo = self.entries.get(key)
+      if stereo is not None:
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return stereo
+      self.misses += 1
+
+    row = key[1]
+    bank = self.bank.at_rate(fs)
+    stereo = render_rows(
+      data,
+      bank,
+      row,
+      bank.mirror[row],
+      self.fft_size
+    )
+    stereo.setflags(write=False)
+    with self.lock:
+      self._insert(key, stereo)
+    return stereo
+
+  def _insert(self, key, stereo):
+    # another thread may have rendered the same key meanwhile
+    if key in self.entries or stereo.nbytes > self.budget:
+      return
+    self.entries[key] = stereo
+    self.nbytes += stereo.nbytes
+    while self.nbytes > self.budget:
+      _, evicted = self.entries.popitem(last=False)
+      self.nbytes -= evicted.nbytes
+      self.evictions += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    """
+    @brief      { Counters for reporting }
+
+    @return     { dict of hits, misses, evictions, entries and bytes }
+    """
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "entries": len(self.entries),
+      "bytes": self.nbytes
+    }
+
+if __name__ == '__main__':
+  # python render.py [wav]: time one trial with both renderers
+  import sys
+  import soundfile as sf
+  from hrtf import HRTFBank
+
+  data, fs = sf.read(sys.argv[1] if len(sys.argv) > 1 else "ping.wav")
+  if data.ndim > 1:
+    data = data[:, 0]
+  bank = HRTFBank.open()
+  bank.spectra(FFT_SIZE)
+
+  for name, render in (
+    ("direct", convolve_stereo_direct),
+    ("spectral", convolve_stereo)
+  ):
+    start = time()
+    for azimuth in range(0, 360, 10):
+      render(data, bank, 0, azimuth)
+    print("{:>8s}: {:.2f} ms per trial".format(
+      name,
+      (time() - start) * 1000 / 36
+    ))
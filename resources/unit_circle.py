@@ -1,84 +1,42 @@
 import curses
-import math
-
-def add_circle_point(window, text, degrees, attribute):
+import os
+import sys
+
+# the widget lives with the experiment one folder up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from circle import CircleSelector
+
+TEXT = (
+  "Move cursor with the arrow keys",
+  "0 degrees is directly in front of you",
+  "180 degrees is directly behind you",
+  "Locate the direction of the ping as best you can",
+  "Press 'Enter' when you are done"
+)
+
+def draw_text(window):
   center_y = window.getmaxyx()[0]
   center_x = window.getmaxyx()[1]
-  seg_length = min(center_y, center_x)/2
-  window.addstr(
-    center_y/2 - int(seg_length * math.cos(math.pi/180 * degrees)), 
-    center_x/2 - len(text)/2 + int(2 * seg_length * math.sin(math.pi/180 * degrees)), 
-    text,
-    attribute
-  )
 
-def get_circle_resp(window):
-  selected = 0
+  for index, line in enumerate(TEXT):
+    window.addstr(center_y//2 - len(TEXT)//2 + index, center_x//2 - len(line)//2, line)
 
-  center_y = window.getmaxyx()[0]
-  center_x = window.getmaxyx()[1]
- 
-  text = list()
-  text.append("Move cursor with the arrow keys")
-  text.append("0 degrees is directly in front of you")
-  text.append("180 degrees is directly behind you")
-  text.append("Locate the direction of the ping as best you can")
-  text.append("Press 'Enter' when you are done")
-
-  for index, line in enumerate(text):
-    window.addstr(center_y/2 - len(text)/2 + index, center_x/2 - len(line)/2, line)
+def get_circle_resp(window, step=10):
+  circle = CircleSelector(window, step)
+  draw_text(window)
+  circle.draw()
 
   while True:
-    for deg in range(0, 360, 10):
-      add_circle_point(
-        window, 
-        str(deg), 
-        deg, 
-        curses.A_REVERSE if deg == selected else curses.A_NORMAL
-      )
-
     window.refresh()
     ch = window.getch()
 
     if ch == curses.KEY_ENTER or ch == ord('\r') or ch == ord('\n'):
-      return selected
-
-    elif ch == curses.KEY_RIGHT:
-      if selected == 90:
-        continue
-      elif selected > 270 or selected < 90:
-        selected += 10
-      else:
-        selected -= 10
-
-    elif ch == curses.KEY_LEFT:
-      if selected == 270:
-        continue
-      if selected > 270 or selected < 90:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_UP:
-      if selected == 0:
-        continue
-      if selected < 180:
-        selected -= 10
-      else:
-        selected += 10
-
-    elif ch == curses.KEY_DOWN:
-      if selected == 180:
-        continue
-      if selected < 180:
-        selected += 10
-      else:
-        selected -= 10
+      return circle.selected
 
-    if selected == 360:
-      selected = 0
-    elif selected == -10:
-      selected = 350
+    if circle.handle(ch):
+      window.clear()
+      draw_text(window)
+      circle.draw()
 
 def main(stdscr):
   stdscr.clear()
@@ -1,25 +1,30 @@
 import numpy as np
-import math
 import sys
 
-f = open(sys.argv[1], "r")
+def read_results(path):
+  """
+  @brief      { Reads a res.csv, e.g. one exported with store.py export }
 
-mat = np.loadtxt(f, delimiter=",")
+  @param      path  The path to the csv file
 
-set_1_avg = float()
-set_2_avg = float()
-set_3_avg = float()
+  @return     { matrix of (response, source) column pairs, one per set }
+  """
+  return np.loadtxt(path, delimiter=",", ndmin=2)
 
-for index in range(0, 10):
-  set_1_avg += (math.cos(math.pi / 180 * abs(mat[index, 0] - mat[index, 1])) + 1)/2
-  set_2_avg += (math.cos(math.pi / 180 * abs(mat[index, 2] - mat[index, 3])) + 1)/2
-  set_3_avg += (math.cos(math.pi / 180 * abs(mat[index, 4] - mat[index, 5])) + 1)/2
+def score(mat):
+  """
+  @brief      { Accuracy of each set, 100% when every response is right }
 
-set_1_avg *= 10
-set_2_avg *= 10
-set_3_avg *= 10
+  A response scores (cos(error) + 1) / 2, so the opposite direction
+  scores 0.
 
-print "Set 1 Average: {0:.2f}%".format(set_1_avg)
-print "Set 2 Average: {0:.2f}%".format(set_2_avg)
-print "Set 3 Average: {0:.2f}%".format(set_3_avg)
+  @param      mat   The matrix returned by read_results
 
+  @return     { array of the average accuracy of each set in percent }
+  """
+  errors = np.abs(mat[:, 0::2] - mat[:, 1::2])
+  return np.mean((np.cos(np.pi / 180 * errors) + 1) / 2, axis=0) * 100
+
+if __name__ == '__main__':
+  for index, average in enumerate(score(read_results(sys.argv[1]))):
+    print("Set {} Average: {:.2f}%".format(index + 1, average))
@@ -0,0 +1,459 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  The listening experiment, driven by an asyncio event loop
+#
+###############################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import asyncio
+import curses
+import sys
+import numpy as np
+
+from circle import CircleSelector
+import instrument
+
+# seconds from the start of the countdown to the ping
+COUNTDOWN = 6
+
+INTRO = (
+  "Welcome to our EE322 final project!",
+  "Move cursor with the arrow keys",
+  "0 degrees is directly in front of you",
+  "180 degrees is directly behind you",
+  "Hover the cursor over the number and",
+  "press 'Enter' to select",
+  "'r' plays the ping again, 'q' quits"
+)
+
+# (text, whether a red asterisk shows where the ping comes from)
+SETS = (
+  ((
+    "Set 1: Best Guess",
+    "Locate the direction of the ping as best you can"
+  ), False),
+  ((
+    "Set 2: Training",
+    "A red asterisk (*) will be shown",
+    "to indicate where the ping is coming from",
+    "Important: The red asterisk may not represent",
+    "exactly where you hear it from",
+    "Locate the direction of the ping as best you can"
+  ), True),
+  ((
+    "Set 3: Training Results",
+    "Now, there won't be any asterisk",
+    "Locate the direction of the ping as best you can"
+  ), False)
+)
+
+ENTER_KEYS = (curses.KEY_ENTER, ord('\r'), ord('\n'))
+REPLAY_KEYS = (ord('r'), ord('R'))
+ABORT_KEYS = (ord('q'), ord('Q'), 27)
+
+class SessionAborted(Exception):
+  pass
+
+def accuracy(responses, sources):
+  """
+  @brief      { Accuracy of a set, 100% when every response is right }
+
+  @param      responses  The selected directions
+  @param      sources    The directions the pings came from
+
+  @return     { average of (cos(error) + 1) / 2 in percent }
+  """
+  errors = np.abs(np.subtract(responses, sources))
+  return float(np.mean((np.cos(np.pi / 180 * errors) + 1) / 2) * 100)
+
+class Session(object):
+  """
+  @brief      { Runs the intro, the trial sets and the results on one loop }
+
+  Key presses are read as soon as they arrive and queued, renders run on
+  an executor depth trials ahead of playback, buffers are submitted on
+  another one and the end of each is awaited on a third, so none of them
+  blocks the others. A trial can be replayed
+  ('r') and the session aborted ('q' or escape) at any point.
+
+  Given an events.EventLog, every trial logs its renders, the submit and
+  first frame out of its ping, the end of the countdown, each key and the
+  selection.
+  """
+
+  def __init__(self, stdscr, renders, data, fs, directions, sink, depth=1,
+               sets=SETS, step=10, events=None):
+    self.stdscr = stdscr
+    self.events = events
+    # set, trial and direction added to the events of the current trial
+    self.trial = dict()
+    self.circle = CircleSelector(stdscr, step)
+    self.renders = renders
+    self.fs = fs
+    self.directions = list(directions)
+    self.sink = sink
+    self.depth = depth
+    self.sets = sets
+    # every set plays the same directions in the same order
+    self.jobs = [
+      (data, 0, direction, fs)
+      for direction in self.directions
+    ] * len(sets)
+
+    # what is on screen, to draw it again after a resize
+    self.lines = ()
+    self.ready = None
+    self.row = 0
+    self.hint = None
+
+    self.stereo = None
+    self.results = list()
+    self.keys = None
+    self.playing = None
+    self.futures = dict()
+    self.renderer = ThreadPoolExecutor(max_workers=1)
+    self.audio = ThreadPoolExecutor(max_workers=1)
+    self.waiter = ThreadPoolExecutor(max_workers=1)
+
+    self.gets = 0
+    self.waits = 0
+    self.wait_time = 0.0
+
+  def run(self):
+    """
+    @brief      { Runs the whole session }
+
+    @return     { list of (sources, responses) per set, or None if aborted }
+    """
+    loop = asyncio.new_event_loop()
+    try:
+      return loop.run_until_complete(self.main())
+    finally:
+      loop.close()
+      self.renderer.shutdown(wait=False)
+      self.audio.shutdown(wait=False)
+      self.waiter.shutdown(wait=False)
+
+  async def main(self):
+    loop = asyncio.get_event_loop()
+    self.keys = asyncio.Queue()
+    self.stdscr.nodelay(True)
+    loop.add_reader(sys.stdin.fileno(), self.read_keys)
+    try:
+      # the first renders hide behind the intro
+      self.prefetch(0)
+      await self.intro()
+      for index, (text, hint) in enumerate(self.sets):
+        self.results.append(await self.trial_set(index, text, hint))
+      await self.outro()
+      self.event("finished")
+      return self.results
+    except SessionAborted:
+      self.sink.cancel()
+      self.event("aborted")
+      return None
+    finally:
+      loop.remove_reader(sys.stdin.fileno())
+      for future in self.futures.values():
+        future.cancel()
+      if self.playing is not None:
+        await self.playing
+
+  def read_keys(self):
+    while True:
+      key = self.stdscr.getch()
+      if key == -1:
+        return
+      self.event("key", key=key)
+      self.keys.put_nowait(key)
+
+  def event(self, name, t=None, **fields):
+    if self.events is None:
+      return
+    context = dict(self.trial)
+    context.update(fields)
+    self.events.log(name, t, **context)
+
+  #############################################################################
+  #
+  # Input
+  #
+  #############################################################################
+
+  async def key(self):
+    """
+    @brief      { Waits for the next key, raising SessionAborted on 'q' }
+    """
+    key = await self.keys.get()
+    if key in ABORT_KEYS:
+      raise SessionAborted()
+    return key
+
+  async def until(self, awaitable):
+    """
+    @brief      { Keeps the circle responsive until awaitable is done }
+
+    @return     { the result of awaitable }
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+      while True:
+        getter = asyncio.ensure_future(self.key())
+        done, _ = await asyncio.wait(
+          [task, getter],
+          return_when=asyncio.FIRST_COMPLETED
+        )
+        if getter in done:
+          self.handle(getter.result())
+        else:
+          getter.cancel()
+          return task.result()
+    except SessionAborted:
+      task.cancel()
+      raise
+
+  def handle(self, key):
+    if self.circle.handle(key):
+      self.redraw()
+    self.stdscr.refresh()
+
+  async def select(self, replay=False):
+    """
+    @brief      { Lets the listener move the cursor until Enter }
+
+    @param      replay  'r' plays the last ping again
+
+    @return     { the selected direction }
+    """
+    self.stdscr.refresh()
+    while True:
+      key = await self.key()
+      if key in ENTER_KEYS:
+        return self.circle.selected
+      if replay and key in REPLAY_KEYS:
+        await self.until(self.play(None))
+      self.handle(key)
+
+  #############################################################################
+  #
+  # Rendering and playback
+  #
+  #############################################################################
+
+  def prefetch(self, index):
+    loop = asyncio.get_event_loop()
+    for ahead in range(index, min(index + self.depth + 1, len(self.jobs))):
+      if ahead not in self.futures:
+        self.futures[ahead] = loop.run_in_executor(
+          self.renderer,
+          self.render,
+          ahead
+        )
+
+  def render(self, index):
+    start = perf_counter()
+    stereo = self.renders.render(*self.jobs[index])
+    end = perf_counter()
+    # rendered ahead, so not part of the current trial
+    trial = {
+      "set": index // len(self.directions) + 1,
+      "trial": index % len(self.directions),
+      "direction": self.jobs[index][2]
+    }
+    self.event("render_start", start, **trial)
+    self.event("render_end", end, duration=end - start, **trial)
+    return stereo
+
+  async def rendered(self, index):
+    """
+    @brief      { The render of a trial, queueing the next ones behind it }
+    """
+    self.prefetch(index)
+    future = self.futures.pop(index)
+    self.prefetch(index + 1)
+
+    self.gets += 1
+    if not future.done():
+      self.waits += 1
+      start = perf_counter()
+      await self.until(future)
+      self.wait_time += perf_counter() - start
+    return future.result()
+
+  async def play(self, at):
+    """
+    @brief      { Plays the current trial at sink time at, None for now }
+
+    A replay cuts the ping still playing short, a scheduled ping lets it
+    finish. Submitting never waits for playback, the end of each ping is
+    awaited on its own executor.
+    """
+    loop = asyncio.get_event_loop()
+    if at is None and self.playing is not None and not self.playing.done():
+      self.sink.cancel()
+      await self.playing
+    # when the first frame is due on our clock rather than the sink's
+    due = None if at is None else perf_counter() + at - self.sink.time()
+    record = await loop.run_in_executor(
+      self.audio,
+      self.sink.play,
+      self.stereo,
+      self.fs,
+      at
+    )
+    self.event("submit", record["submitted"], buffer=record["index"],
+               replay=at is None)
+    # completion is awaited on the side, the circle stays live meanwhile
+    self.playing = loop.run_in_executor(self.waiter, self.sink.wait, record)
+    trial = dict(self.trial)
+    self.playing.add_done_callback(
+      lambda _: self.played(record, due, trial)
+    )
+
+  def played(self, record, due, trial):
+    first = record["first_frame"]
+    if first is not None:
+      instrument.observe("sinks.latency", first - record["submitted"])
+    instrument.count("sinks.late", "late" in record)
+    self.event(
+      "played",
+      record["last_frame"],
+      buffer=record["index"],
+      first_frame=None if self.events is None else self.events.since(first),
+      latency=None if first is None else first - record["submitted"],
+      lateness=None if first is None or due is None else first - due,
+      late="late" in record,
+      cancelled=record.get("cancelled", False),
+      **trial
+    )
+
+  async def countdown(self, onset):
+    for index in range(COUNTDOWN - 1, -1, -1):
+      self.draw_centered(self.row, "Ping in {}".format(index))
+      self.stdscr.refresh()
+      await asyncio.sleep(max(onset - index - self.sink.time(), 0))
+
+  #############################################################################
+  #
+  # Screens
+  #
+  #############################################################################
+
+  def draw_centered(self, row, line, attribute=curses.A_NORMAL):
+    self.stdscr.addstr(
+      row,
+      self.stdscr.getmaxyx()[1]//2 - len(line)//2,
+      line,
+      attribute
+    )
+
+  def redraw(self):
+    """
+    @brief      { Draws the whole screen again, after a clear or a resize }
+    """
+    self.stdscr.clear()
+    top = self.stdscr.getmaxyx()[0]//2 - len(self.lines)//2
+    for index, line in enumerate(self.lines):
+      self.draw_centered(top + index, line)
+    self.row = top + len(self.lines)
+
+    if self.ready is not None:
+      column = self.stdscr.getmaxyx()[1]//2
+      self.stdscr.addstr(self.row, column - len(self.ready)//2, self.ready)
+      self.stdscr.addstr(
+        self.row,
+        column + len(self.ready)//2,
+        "[ENTER]",
+        curses.A_BLINK | curses.A_REVERSE
+      )
+    self.circle.draw()
+    if self.hint is not None:
+      self.circle.point(self.hint, "*", curses.color_pair(1))
+
+  def show_hint(self, direction):
+    if self.hint is not None:
+      self.circle.point(self.hint, " ", curses.A_NORMAL)
+    self.hint = direction
+    if direction is not None:
+      self.circle.point(direction, "*", curses.color_pair(1))
+    self.stdscr.refresh()
+
+  async def prompt(self, lines, ready="Ready? "):
+    """
+    @brief      { Shows lines and the circle until Enter is pressed }
+    """
+    self.lines = lines
+    self.ready = ready
+    self.redraw()
+    await self.select()
+    self.ready = None
+    column = self.stdscr.getmaxyx()[1]//2
+    self.stdscr.addstr(self.row, column + len(ready)//2, " " * len("[ENTER]"))
+
+  async def intro(self):
+    await self.prompt(INTRO)
+
+  async def trial_set(self, number, text, hint):
+    """
+    @brief      { Plays every direction once and collects the responses }
+
+    @param      number  The index of the set
+    @param      text    lines shown before the set
+    @param      hint    Show where the ping comes from
+
+    @return     { (sources, responses) }
+    """
+    await self.prompt(text)
+    sources = list()
+    responses = list()
+
+    for trial, direction in enumerate(self.directions):
+      self.trial = {"set": number + 1, "trial": trial, "direction": direction}
+      self.event("trial_start")
+      sources.append(direction)
+      if hint:
+        self.show_hint(direction)
+
+      self.stereo = await self.rendered(number * len(self.directions) + trial)
+      # the ping is due when the countdown reaches 0, on the clock of the
+      # output stream
+      onset = self.sink.time() + COUNTDOWN
+      await self.until(asyncio.gather(self.play(onset), self.countdown(onset)))
+      countdown_end = perf_counter()
+      self.event("countdown_end", countdown_end)
+
+      responses.append(await self.select(replay=True))
+      selected = perf_counter()
+      self.event("selection", selected, response=responses[-1],
+                 reaction=selected - countdown_end)
+
+      if hint:
+        self.show_hint(None)
+
+    self.trial = dict()
+    return sources, responses
+
+  async def outro(self):
+    lines = ["Game Over!"] + [
+      "Set {} results: {:.2f}% Accuracy".format(
+        index + 1,
+        accuracy(responses, sources)
+      )
+      for index, (sources, responses) in enumerate(self.results)
+    ]
+    await self.prompt(lines, "Finished? ")
+
+  def stats(self):
+    """
+    @brief      { How often playback had to wait for a render }
+
+    @return     { dict of gets, waits and wait_time }
+    """
+    return {
+      "gets": self.gets,
+      "waits": self.waits,
+      "wait_time": self.wait_time
+    }
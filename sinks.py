@@ -0,0 +1,491 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Audio outputs: the sound card, wav files or nothing at all
+#
+###############################################################################
+
+from time import perf_counter, sleep
+import json
+import os
+import threading
+import numpy as np
+import instrument
+
+class Sink(object):
+  """
+  @brief      { Plays stereo buffers one at a time and times each of them }
+
+  play() submits a buffer and returns at once, wait() blocks until it has
+  been played, from any thread. Every buffer gets a record in playbacks
+  with perf_counter() times of when it was submitted and when its first
+  and last frames went out, which the sound card only knows
+  approximately. A buffer may be played at a given time on the clock of
+  the sink, see time().
+  """
+
+  def __init__(self):
+    self.playbacks = list()
+    self.started = perf_counter()
+
+  def open(self, fs, channels=2):
+    """
+    @brief      { Gets ready to play at fs, before the first buffer }
+    """
+    pass
+
+  def time(self):
+    """
+    @brief      { The clock play() schedules against, in seconds }
+    """
+    return perf_counter() - self.started
+
+  @instrument.timed("sinks.play")
+  def play(self, stereo, fs, at=None):
+    """
+    @brief      { Starts playing a buffer }
+
+    @param      stereo  matrix shaped (frames, channels)
+    @param      fs      The sample rate
+    @param      at      time() the first frame is due, None for right away
+
+    @return     { the timing record of the buffer, filled in as it plays }
+    """
+    record = {
+      "index": len(self.playbacks),
+      "frames": len(stereo),
+      "fs": fs,
+      "at": at,
+      "submitted": perf_counter(),
+      "first_frame": None,
+      "last_frame": None
+    }
+    self.playbacks.append(record)
+    self._start(np.asarray(stereo), fs, record)
+    return record
+
+  def _start(self, stereo, fs, record):
+    raise NotImplementedError
+
+  def wait(self, record=None):
+    """
+    @brief      { Blocks until a buffer has been played }
+
+    @param      record  The record play() returned, None for the last one
+    """
+    pass
+
+  def _last(self, record):
+    if record is None and self.playbacks:
+      return self.playbacks[-1]
+    return record
+
+  def cancel(self):
+    """
+    @brief      { Stops the last buffer, or keeps it from starting }
+    """
+    if self.playbacks:
+      self.playbacks[-1]["cancelled"] = True
+
+  def close(self):
+    self.wait()
+
+  def stats(self):
+    """
+    @brief      { Latencies for reporting }
+
+    @return     { dict of the number of buffers, the mean and worst time
+                  from submit to first frame out of the buffers played
+                  right away, and how many scheduled ones started late }
+    """
+    latencies = [
+      record["first_frame"] - record["submitted"]
+      for record in self.playbacks
+      if record["first_frame"] is not None and record["at"] is None
+    ]
+    return {
+      "buffers": len(self.playbacks),
+      "mean_latency": float(np.mean(latencies)) if latencies else 0.0,
+      "max_latency": max(latencies) if latencies else 0.0,
+      "late": sum("late" in record for record in self.playbacks)
+    }
+
+class DeviceSink(Sink):
+  """
+  @brief      { Plays through sounddevice, like sd.play() }
+
+  The frame times are taken in the stream callback and moved forward by
+  how far ahead of the DAC the callback runs, as reported by PortAudio.
+  Every buffer opens its own stream, so at is only approximate, see
+  StreamSink.
+  """
+
+  def __init__(self, device=None, latency=None):
+    super(DeviceSink, self).__init__()
+    self.device = device
+    self.latency = latency
+    self.timer = None
+    # record index -> (its stream, set once the stream has finished)
+    self.streams = dict()
+    self.lock = threading.Lock()
+
+  def _start(self, stereo, fs, record):
+    import sounddevice as sd
+
+    if record["index"]:
+      self.wait(self.playbacks[record["index"] - 1])
+    stereo = np.ascontiguousarray(stereo, dtype=np.float32)
+    position = [0]
+
+    def callback(outdata, frames, time, status):
+      now = perf_counter()
+      # some host APIs report no DAC time
+      ahead = max(time.outputBufferDacTime - time.currentTime, 0)
+      start = position[0]
+      chunk = stereo[start:start + frames]
+      outdata[:len(chunk)] = chunk
+      outdata[len(chunk):] = 0
+      position[0] += len(chunk)
+
+      if start == 0:
+        record["first_frame"] = now + ahead
+      if position[0] >= len(stereo):
+        record["last_frame"] = now + ahead + len(chunk) / float(fs)
+        raise sd.CallbackStop
+
+    finished = threading.Event()
+    stream = sd.OutputStream(
+      samplerate=fs,
+      channels=stereo.shape[1],
+      dtype="float32",
+      device=self.device,
+      latency=self.latency,
+      callback=callback,
+      finished_callback=finished.set
+    )
+    with self.lock:
+      self.streams[record["index"]] = (stream, finished)
+    if record["at"] is None:
+      stream.start()
+    else:
+      self.timer = threading.Timer(
+        max(record["at"] - self.time(), 0),
+        stream.start
+      )
+      self.timer.start()
+
+  def cancel(self):
+    super(DeviceSink, self).cancel()
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    with self.lock:
+      stream, finished = self.streams.get(
+        len(self.playbacks) - 1,
+        (None, None)
+      )
+    if stream is not None:
+      stream.abort()
+      # a stream that never started never calls finished_callback
+      finished.set()
+
+  def wait(self, record=None):
+    record = self._last(record)
+    if record is None:
+      return
+    with self.lock:
+      stream, finished = self.streams.get(record["index"], (None, None))
+    if stream is None:
+      return
+    finished.wait()
+    with self.lock:
+      if self.streams.pop(record["index"], None) is not None:
+        stream.close()
+
+class FileSink(Sink):
+  """
+  @brief      { Writes every buffer to a wav file instead of playing it }
+
+  Buffer i goes to directory/NNNN.wav and its record, with the file name,
+  is appended to directory/playback.jsonl, so a session can be listened
+  to or replayed exactly later. The frame times are when writing started
+  and finished.
+  """
+
+  def __init__(self, directory):
+    super(FileSink, self).__init__()
+    self.directory = directory
+    try:
+      os.makedirs(directory)
+    except OSError:
+      if not os.path.isdir(directory):
+        raise
+    self.log = open(os.path.join(directory, "playback.jsonl"), "a")
+
+  def _start(self, stereo, fs, record):
+    import soundfile as sf
+
+    record["path"] = "{:04d}.wav".format(record["index"])
+    record["first_frame"] = perf_counter()
+    sf.write(
+      os.path.join(self.directory, record["path"]),
+      stereo,
+      fs,
+      subtype="FLOAT"
+    )
+    record["last_frame"] = perf_counter()
+    self.log.write(json.dumps(record) + "\n")
+    self.log.flush()
+
+  def close(self):
+    self.log.close()
+
+class NullSink(Sink):
+  """
+  @brief      { Discards the buffers, in real time or as fast as possible }
+
+  In real time wait() sleeps until the buffer would have finished playing,
+  otherwise every buffer is done as soon as it is submitted.
+  """
+
+  def __init__(self, realtime=True):
+    super(NullSink, self).__init__()
+    self.realtime = realtime
+
+  def _start(self, stereo, fs, record):
+    record["first_frame"] = record["submitted"]
+    if self.realtime and record["at"] is not None:
+      record["first_frame"] = max(
+        record["submitted"],
+        self.started + record["at"]
+      )
+    record["last_frame"] = record["first_frame"]
+    if self.realtime:
+      record["last_frame"] += len(stereo) / float(fs)
+
+  def wait(self, record=None):
+    record = self._last(record)
+    if record is not None:
+      remaining = record["last_frame"] - perf_counter()
+      if remaining > 0:
+        sleep(remaining)
+
+  def cancel(self):
+    super(NullSink, self).cancel()
+    if self.playbacks:
+      record = self.playbacks[-1]
+      record["last_frame"] = min(record["last_frame"], perf_counter())
+
+class Scheduler(object):
+  """
+  @brief      { Mixes buffers into a stream at the exact frame they are due }
+
+  The clock counts the frames handed to the stream, so a buffer scheduled
+  at time T starts at frame round(T * fs) and times never drift against
+  the sound card. process() fills one block and is meant to be called from
+  the stream callback. A buffer due before the block being filled starts
+  late, at the next block, and says so in its record.
+  """
+
+  def __init__(self, fs, channels=2):
+    self.fs = fs
+    self.channels = channels
+    self.clock = 0
+    self.pending = list()
+    self.late = 0
+    self.changed = threading.Condition()
+
+  def time(self):
+    """
+    @brief      { Stream time of the next block to be filled, in seconds }
+    """
+    return self.clock / float(self.fs)
+
+  def schedule(self, stereo, at, record):
+    """
+    @brief      { Queues a buffer to start at stream time at }
+
+    @param      stereo  matrix shaped (frames, channels)
+    @param      at      stream time in seconds, None for the next block
+    @param      record  timing record updated as the buffer plays
+    """
+    with self.changed:
+      start = self.clock if at is None else int(round(at * self.fs))
+      if start < self.clock:
+        record["late"] = (self.clock - start) / float(self.fs)
+        self.late += 1
+        start = self.clock
+      record["start"] = start
+      if len(stereo):
+        self.pending.append((start, stereo, record))
+      else:
+        record["first_frame"] = record["last_frame"] = perf_counter()
+
+  def process(self, outdata, now=None, ahead=0.0):
+    """
+    @brief      { Fills the next block with every buffer that overlaps it }
+
+    @param      outdata  block shaped (frames, channels), overwritten
+    @param      now      perf_counter() when the block was requested
+    @param      ahead    seconds until the block reaches the DAC
+    """
+    if now is None:
+      now = perf_counter()
+    frames = len(outdata)
+    outdata.fill(0)
+
+    with self.changed:
+      finished = list()
+      for item in self.pending:
+        start, stereo, record = item
+        if start >= self.clock + frames:
+          continue
+        into = max(start - self.clock, 0)
+        source = max(self.clock - start, 0)
+        count = min(frames - into, len(stereo) - source)
+        outdata[into:into + count] += stereo[source:source + count]
+
+        if source == 0:
+          record["first_frame"] = now + ahead + into / float(self.fs)
+        if source + count == len(stereo):
+          record["last_frame"] = (
+            now + ahead + (into + count) / float(self.fs)
+          )
+          finished.append(item)
+
+      for item in finished:
+        self.pending.remove(item)
+      self.clock += frames
+      if finished:
+        self.changed.notify_all()
+
+  def cancel(self, record):
+    """
+    @brief      { Drops a scheduled buffer, whether it has started or not }
+
+    @param      record  The record given to schedule()
+    """
+    with self.changed:
+      self.pending = [item for item in self.pending if item[2] is not record]
+      if record["last_frame"] is None:
+        record["last_frame"] = perf_counter()
+      self.changed.notify_all()
+
+  def wait(self, record, timeout=None):
+    """
+    @brief      { Blocks until a scheduled buffer has been mixed in }
+
+    @param      record   The record given to schedule()
+    @param      timeout  seconds to give up after, None for never
+
+    @return     { True if the buffer is done }
+    """
+    with self.changed:
+      return self.changed.wait_for(
+        lambda: record["last_frame"] is not None,
+        timeout
+      )
+
+class StreamSink(Sink):
+  """
+  @brief      { Keeps one sounddevice stream open and schedules into it }
+
+  The stream is opened once for the session (see open()) and fed by a
+  Scheduler, so there is no device start up per buffer, time() is the
+  stream time and a buffer played at time T starts at exactly that frame.
+  """
+
+  def __init__(self, device=None, latency="low", blocksize=0):
+    super(StreamSink, self).__init__()
+    self.device = device
+    self.latency = latency
+    self.blocksize = blocksize
+    self.stream = None
+    self.scheduler = None
+    self.xruns = 0
+
+  def open(self, fs, channels=2):
+    import sounddevice as sd
+
+    if self.scheduler is not None and (
+      self.scheduler.fs == fs and self.scheduler.channels == channels
+    ):
+      return
+    self.close()
+    self.scheduler = Scheduler(fs, channels)
+    self.stream = sd.OutputStream(
+      samplerate=fs,
+      channels=channels,
+      dtype="float32",
+      device=self.device,
+      latency=self.latency,
+      blocksize=self.blocksize,
+      callback=self.callback
+    )
+    self.stream.start()
+
+  def callback(self, outdata, frames, time, status):
+    if status.output_underflow:
+      self.xruns += 1
+    self.scheduler.process(
+      outdata,
+      perf_counter(),
+      max(time.outputBufferDacTime - time.currentTime, 0)
+    )
+
+  def time(self):
+    return 0.0 if self.scheduler is None else self.scheduler.time()
+
+  def _start(self, stereo, fs, record):
+    self.open(fs, stereo.shape[1])
+    self.scheduler.schedule(
+      np.ascontiguousarray(stereo, dtype=np.float32),
+      record["at"],
+      record
+    )
+
+  def wait(self, record=None):
+    record = self._last(record)
+    if record is not None and self.scheduler is not None:
+      self.scheduler.wait(record)
+
+  def cancel(self):
+    super(StreamSink, self).cancel()
+    if self.playbacks and self.scheduler is not None:
+      self.scheduler.cancel(self.playbacks[-1])
+
+  def close(self):
+    if self.stream is not None:
+      self.wait()
+      self.stream.stop()
+      self.stream.close()
+      self.stream = None
+      self.scheduler = None
+
+  def stats(self):
+    stats = super(StreamSink, self).stats()
+    stats["xruns"] = self.xruns
+    return stats
+
+def open_sink(spec):
+  """
+  @brief      { Builds a sink from a command line description }
+
+  @param      spec  stream[:NAME], device[:NAME], file:DIRECTORY, null or
+                    null:fast
+
+  @return     { Sink }
+  """
+  kind, _, argument = spec.partition(":")
+  device = int(argument) if argument.isdigit() else argument or None
+  if kind == "stream":
+    return StreamSink(device)
+  if kind == "device":
+    return DeviceSink(device)
+  if kind == "file" and argument:
+    return FileSink(argument)
+  if kind == "null" and argument in ("", "fast"):
+    return NullSink(realtime=argument != "fast")
+  raise ValueError("unknown sink {}, use stream[:NAME], device[:NAME], "
+                   "file:DIRECTORY, null or null:fast".format(spec))
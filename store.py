@@ -0,0 +1,257 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Append only store of every session's responses
+#
+###############################################################################
+
+from time import time
+import datetime
+import json
+import os
+import sqlite3
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# every session on this machine is appended here
+RESULTS_DB = os.path.join(HERE, "results", "results.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+  id INTEGER PRIMARY KEY,
+  subject TEXT NOT NULL,
+  started REAL NOT NULL,
+  date TEXT NOT NULL,
+  stimulus TEXT,
+  info TEXT
+);
+CREATE TABLE IF NOT EXISTS trials (
+  session INTEGER NOT NULL REFERENCES sessions(id),
+  trial_set INTEGER NOT NULL,
+  trial INTEGER NOT NULL,
+  elevation REAL NOT NULL,
+  source REAL NOT NULL,
+  response REAL NOT NULL,
+  PRIMARY KEY (session, trial_set, trial)
+);
+CREATE INDEX IF NOT EXISTS sessions_subject ON sessions(subject, started);
+CREATE INDEX IF NOT EXISTS sessions_date ON sessions(date);
+CREATE TRIGGER IF NOT EXISTS sessions_append_only
+  BEFORE UPDATE ON sessions
+  BEGIN SELECT RAISE(ABORT, 'results are append only'); END;
+CREATE TRIGGER IF NOT EXISTS sessions_keep
+  BEFORE DELETE ON sessions
+  BEGIN SELECT RAISE(ABORT, 'results are append only'); END;
+CREATE TRIGGER IF NOT EXISTS trials_append_only
+  BEFORE UPDATE ON trials
+  BEGIN SELECT RAISE(ABORT, 'results are append only'); END;
+CREATE TRIGGER IF NOT EXISTS trials_keep
+  BEFORE DELETE ON trials
+  BEGIN SELECT RAISE(ABORT, 'results are append only'); END;
+"""
+
+class ResultsStore(object):
+  """
+  @brief      { SQLite file every session is appended to }
+
+  A session and its trials go in as one transaction, and the file is in
+  write ahead log mode, so sessions running side by side on one machine
+  only wait for each other's commits and readers never see half a
+  session. Nothing is ever updated or deleted, the triggers refuse it.
+  """
+
+  def __init__(self, path=RESULTS_DB, timeout=30.0):
+    self.path = path
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.connection = sqlite3.connect(path, timeout=timeout)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    with self.connection:
+      self.connection.executescript(SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def add_session(self, subject, results, started=None, stimulus=None,
+                  elevation=0, **info):
+    """
+    @brief      { Appends a session }
+
+    @param      subject    Who took part
+    @param      results    list of (sources, responses) per set, what
+                           session.Session.run() returns
+    @param      started    unix time the session started, None for now
+    @param      stimulus   The source played, e.g. ping.wav
+    @param      elevation  The elevation every trial was rendered at
+    @param      info       anything else worth keeping, stored as json
+
+    @return     { the id of the new session }
+    """
+    if started is None:
+      started = time()
+    date = datetime.date.fromtimestamp(started).isoformat()
+    with self.connection:
+      cursor = self.connection.execute(
+        "INSERT INTO sessions (subject, started, date, stimulus, info) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (subject, started, date, stimulus, json.dumps(info, sort_keys=True))
+      )
+      session = cursor.lastrowid
+      self.connection.executemany(
+        "INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?)",
+        [
+          (session, trial_set + 1, trial, elevation, source, response)
+          for trial_set, (sources, responses) in enumerate(results)
+          for trial, (source, response) in enumerate(zip(sources, responses))
+        ]
+      )
+    return session
+
+  def import_csv(self, path, subject, started=None, **info):
+    """
+    @brief      { Appends a res.csv written by an earlier version }
+
+    @param      path     The csv file, (response, source) pairs per set
+    @param      subject  Who took part
+    @param      started  unix time of the session, None for the file's
+
+    @return     { the id of the new session }
+    """
+    mat = np.loadtxt(path, delimiter=",", ndmin=2)
+    if started is None:
+      started = os.path.getmtime(path)
+    info["imported"] = os.path.basename(path)
+    return self.add_session(
+      subject,
+      [
+        (mat[:, column + 1].tolist(), mat[:, column].tolist())
+        for column in range(0, mat.shape[1], 2)
+      ],
+      started,
+      "ping.wav",
+      **info
+    )
+
+  def sessions(self, subject=None, since=None, until=None):
+    """
+    @brief      { Lists sessions, oldest first }
+
+    @param      subject  Only this subject's, None for everyone's
+    @param      since    first date, YYYY-MM-DD, None for no limit
+    @param      until    last date, YYYY-MM-DD, None for no limit
+
+    @return     { list of dicts of the session columns }
+    """
+    where, values = list(), list()
+    for clause, value in (
+      ("subject = ?", subject),
+      ("date >= ?", since),
+      ("date <= ?", until)
+    ):
+      if value is not None:
+        where.append(clause)
+        values.append(value)
+    cursor = self.connection.execute(
+      "SELECT * FROM sessions{} ORDER BY started, id".format(
+        " WHERE " + " AND ".join(where) if where else ""
+      ),
+      values
+    )
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+  def matrix(self, session):
+    """
+    @brief      { A session's responses laid out like res.csv }
+
+    @param      session  The id of the session
+
+    @return     { matrix of (response, source) column pairs, one per set,
+                  ready for results/process.py }
+    """
+    rows = self.connection.execute(
+      "SELECT trial_set, trial, source, response FROM trials "
+      "WHERE session = ? ORDER BY trial_set, trial",
+      (session,)
+    ).fetchall()
+    if not rows:
+      return np.zeros((0, 0))
+    rows = np.array(rows)
+    sets = int(rows[:, 0].max())
+    mat = np.zeros((len(rows) // sets, 2 * sets))
+    for trial_set in range(sets):
+      chosen = rows[rows[:, 0] == trial_set + 1]
+      mat[:, 2 * trial_set] = chosen[:, 3]
+      mat[:, 2 * trial_set + 1] = chosen[:, 2]
+    return mat
+
+if __name__ == '__main__':
+  # python store.py [--db FILE] import results/*.csv
+  # python store.py [--db FILE] list [--subject NAME] [--since YYYY-MM-DD]
+  # python store.py [--db FILE] export ID res.csv
+  import argparse
+  import re
+  from session import accuracy
+
+  parser = argparse.ArgumentParser(description="Experiment results")
+  parser.add_argument("--db", default=RESULTS_DB, help="results file")
+  commands = parser.add_subparsers(dest="command")
+
+  command = commands.add_parser("import", help="append old res.csv files")
+  command.add_argument("paths", nargs="+", help="csv files")
+  command.add_argument("--subject", default=None,
+                       help="subject of every file, by default the file "
+                            "name without its trailing number")
+
+  command = commands.add_parser("list", help="list sessions and scores")
+  command.add_argument("--subject", default=None)
+  command.add_argument("--since", default=None, help="YYYY-MM-DD")
+  command.add_argument("--until", default=None, help="YYYY-MM-DD")
+
+  command = commands.add_parser("export", help="write a session as csv")
+  command.add_argument("session", type=int, help="session id")
+  command.add_argument("out", help="csv file")
+
+  args = parser.parse_args()
+  store = ResultsStore(args.db)
+
+  if args.command == "import":
+    for path in args.paths:
+      subject = args.subject or re.sub(
+        r"\d*$",
+        "",
+        os.path.splitext(os.path.basename(path))[0]
+      )
+      print("{} -> session {} ({})".format(
+        path,
+        store.import_csv(path, subject),
+        subject
+      ))
+
+  elif args.command == "export":
+    np.savetxt(args.out, store.matrix(args.session), fmt="%g", delimiter=",")
+
+  else:
+    for session in store.sessions(
+      getattr(args, "subject", None),
+      getattr(args, "since", None),
+      getattr(args, "until", None)
+    ):
+      mat = store.matrix(session["id"])
+      scores = [
+        accuracy(mat[:, column], mat[:, column + 1])
+        for column in range(0, mat.shape[1], 2)
+      ]
+      print("{:5d} {:12s} {} {}".format(
+        session["id"],
+        session["subject"],
+        datetime.datetime.fromtimestamp(session["started"]).strftime(
+          "%Y-%m-%d %H:%M"
+        ),
+        " ".join("{:6.2f}%".format(score) for score in scores)
+      ))
+
+  store.close()
@@ -0,0 +1,278 @@
+###############################################################################
+#
+#  USC EE322 Final Project - Spring 2019
+#
+#  Block based binaural rendering with uniformly partitioned overlap-save
+#
+###############################################################################
+
+from time import perf_counter
+import asyncio
+import numpy as np
+
+BLOCKSIZE = 512
+
+class PartitionedConvolver(object):
+  """
+  @brief      { Block by block stereo convolution (uniform partitions) }
+
+  The filter pair is split into partitions of one block each. Every new
+  block of input is transformed once, pushed onto a frequency domain delay
+  line and multiplied with the partition spectra of both ears, so the
+  output of a block is ready as soon as its input is.
+  """
+
+  def __init__(self, partitions, block):
+    """
+    @param      partitions  complex array shaped (2, partition, block + 1)
+    @param      block       The block length
+    """
+    self.block = block
+    self.partitions = partitions
+    self.previous = None
+    self.history = np.zeros(
+      (partitions.shape[1], block + 1),
+      dtype=np.complex128
+    )
+    self.window = np.zeros(2 * block)
+
+    # raised cosine over one block for switching filters
+    ramp = np.sin(0.5 * np.pi * (np.arange(block) + 0.5) / block) ** 2
+    self.fade_in = ramp[:, np.newaxis]
+    self.fade_out = 1 - self.fade_in
+
+  def switch(self, partitions):
+    """
+    @brief      { Swaps the filter pair, crossfading over the next block }
+
+    @param      partitions  complex array shaped (2, partition, block + 1)
+    """
+    if partitions is self.partitions:
+      return
+    if self.previous is None:
+      self.previous = self.partitions
+    self.partitions = partitions
+
+  def _convolve(self, partitions):
+    spectrum = np.einsum("epk,pk->ek", partitions, self.history)
+    return np.fft.irfft(spectrum, n=2 * self.block, axis=-1)[:, self.block:].T
+
+  def process(self, block):
+    """
+    @brief      { Convolves the next block of input }
+
+    @param      block  mono input, self.block samples
+
+    @return     { stereo output shaped (self.block, 2) }
+    """
+    # overlap-save: transform the previous and the current block together
+    self.window[:self.block] = self.window[self.block:]
+    self.window[self.block:] = block
+
+    self.history = np.roll(self.history, 1, axis=0)
+    self.history[0] = np.fft.rfft(self.window)
+
+    output = self._convolve(self.partitions)
+    if self.previous is not None:
+      # both filters see the same input history, so the old one simply
+      # keeps ringing while it fades out
+      output = (
+        self.fade_in * output +
+        self.fade_out * self._convolve(self.previous)
+      )
+      self.previous = None
+    return output
+
+class StreamRenderer(object):
+  """
+  @brief      { Feeds a sounddevice output callback from the convolver }
+
+  Nothing is rendered ahead of time, each callback convolves exactly the
+  block it plays, so the sound starts one block after the trigger no matter
+  how long the source is.
+  """
+
+  def __init__(self, data, bank, elevation, azimuth, blocksize=BLOCKSIZE,
+               fs=None):
+    bank = bank.at_rate(fs).delayed()
+    row = bank.lookup(elevation, azimuth)
+    partitions = bank.partitions(blocksize)[bank.ears(row)]
+
+    self.convolver = self.make_convolver(partitions, blocksize)
+    self.blocksize = blocksize
+    self.data = data
+    # keep going until the filter tail has rung out
+    self.length = np.shape(data)[-1] + bank.taps - 1
+    self.position = 0
+    self.xruns = 0
+    self.late = 0
+    self.budget = None
+
+  def make_convolver(self, partitions, blocksize):
+    return PartitionedConvolver(partitions, blocksize)
+
+  def done(self):
+    return self.position >= self.length
+
+  def process(self, outdata):
+    """
+    @brief      { Renders the next block straight into outdata }
+
+    @param      outdata  array shaped (blocksize, 2)
+    """
+    block = self.data[self.position:self.position + self.blocksize]
+    if len(block) < self.blocksize:
+      block = np.concatenate([block, np.zeros(self.blocksize - len(block))])
+
+    outdata[:] = self.convolver.process(block)
+
+    # zero what is left of the last block past the tail
+    remaining = self.length - self.position
+    if remaining < self.blocksize:
+      outdata[remaining:] = 0
+    self.position += self.blocksize
+
+  def callback(self, outdata, frames, time_info, status):
+    start = perf_counter()
+    if status.output_underflow:
+      self.xruns += 1
+
+    self.process(outdata)
+
+    # a block that takes longer than it lasts will underflow eventually
+    if self.budget is not None and perf_counter() - start > self.budget:
+      self.late += 1
+
+  async def play(self, fs, **kwargs):
+    """
+    @brief      { Streams the rendered source to the output device }
+
+    @param      fs      The sample rate
+    @param      kwargs  passed on to sounddevice.OutputStream
+
+    @return     { number of xruns reported by the device }
+    """
+    import sounddevice as sd
+
+    loop = asyncio.get_event_loop()
+    finished = asyncio.Event()
+    self.budget = self.blocksize / float(fs)
+
+    def callback(outdata, frames, time_info, status):
+      self.callback(outdata, frames, time_info, status)
+      if self.done():
+        raise sd.CallbackStop
+
+    stream = sd.OutputStream(
+      samplerate=fs,
+      blocksize=self.blocksize,
+      channels=2,
+      dtype='float32',
+      callback=callback,
+      finished_callback=lambda: loop.call_soon_threadsafe(finished.set),
+      **kwargs
+    )
+    with stream:
+      await finished.wait()
+    return self.xruns
+
+def sweep(duration, turns=1.0, start=0.0, elevation=0.0, points=361):
+  """
+  @brief      { Trajectory going around the head at a constant speed }
+
+  @param      duration   Length of the sweep in seconds
+  @param      turns      Number of full turns, negative goes the other way
+  @param      start      Azimuth at time 0
+  @param      elevation  Constant elevation
+  @param      points     Number of waypoints
+
+  @return     { (times, elevations, azimuths) }
+  """
+  times = np.linspace(0, duration, points)
+  azimuths = start + 360.0 * turns * times / duration
+  return times, np.full(points, float(elevation)), azimuths
+
+def trajectory_rows(bank, times, elevations, azimuths, block_times):
+  """
+  @brief      { Resolves a time stamped path to bank rows, one per block }
+
+  @param      bank         The HRTFBank
+  @param      times        waypoint times in seconds, increasing
+  @param      elevations   waypoint elevations
+  @param      azimuths     waypoint azimuths
+  @param      block_times  times at which each block is rendered
+
+  @return     { bank row of every block }
+  """
+  # unwrap so that going from 350 to 10 passes through 0, not 180
+  unwrapped = np.rad2deg(np.unwrap(np.deg2rad(azimuths)))
+  azimuth = np.interp(block_times, times, unwrapped)
+  elevation = np.interp(block_times, times, elevations)
+
+  return bank.lookup(elevation, azimuth)
+
+def render_trajectory(data, bank, fs, times, elevations, azimuths,
+                      blocksize=BLOCKSIZE):
+  """
+  @brief      { Renders a moving source, switching filters every block }
+
+  The filter pair is looked up at the middle of each block and crossfaded
+  from the previous pair whenever it changes. The partition spectra come
+  from the bank, nothing is transformed per block but the input.
+
+  @param      data        mono source signal
+  @param      bank        The HRTFBank
+  @param      fs          The sample rate
+  @param      times       waypoint times in seconds
+  @param      elevations  waypoint elevations
+  @param      azimuths    waypoint azimuths
+  @param      blocksize   samples per block
+
+  @return     { stereo matrix ready to be played }
+  """
+  bank = bank.at_rate(fs).delayed()
+  length = len(data) + bank.taps - 1
+  n_blocks = -(-length // blocksize)
+  padded = np.zeros(n_blocks * blocksize)
+  padded[:len(data)] = data
+
+  block_times = (np.arange(n_blocks) + 0.5) * blocksize / float(fs)
+  rows = trajectory_rows(bank, times, elevations, azimuths, block_times)
+
+  partitions = bank.partitions(blocksize)
+  convolver = PartitionedConvolver(partitions[bank.ears(rows[0])], blocksize)
+
+  stereo = np.empty((n_blocks * blocksize, 2))
+  changed = np.ones(n_blocks, dtype=bool)
+  changed[1:] = rows[1:] != rows[:-1]
+
+  for index in range(n_blocks):
+    if index and changed[index]:
+      convolver.switch(partitions[bank.ears(rows[index])])
+    start = index * blocksize
+    stereo[start:start + blocksize] = convolver.process(
+      padded[start:start + blocksize]
+    )
+  return stereo[:length]
+
+if __name__ == "__main__":
+  # python stream.py [wav] [azimuth] [elevation]
+  import sys
+  import soundfile as sf
+  from hrtf import HRTFBank
+
+  data, fs = sf.read(sys.argv[1] if len(sys.argv) > 1 else "ping.wav")
+  if data.ndim > 1:
+    data = data[:, 0]
+  azimuth = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+  elevation = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+  renderer = StreamRenderer(
+    data,
+    HRTFBank.open(),
+    elevation,
+    azimuth,
+    fs=fs
+  )
+  xruns = asyncio.run(renderer.play(fs))
+  print("xruns: {}, late blocks: {}".format(xruns, renderer.late))